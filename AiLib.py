@@ -1,5 +1,17 @@
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core.client_options import ClientOptions
+import asyncio
+import hashlib
+import logging
 import os
+import random
+import threading
+import weakref
+from datetime import datetime, timedelta
+from cachetools import LRUCache
+from pymongo import ASCENDING
+from utils.mongo import get_db, MONGO_URI
+from utils import metrics
 from dotenv import load_dotenv
 import time
 
@@ -9,9 +21,117 @@ gemini_api_keys = os.getenv("GEMINI_API_KEYS", "").split(",")
 gemini_api_keys = [key.strip() for key in gemini_api_keys if key.strip()]
 GEMINI_MODEL = "gemini-1.5-flash"
 
+LLM_CACHE_COLLECTION = "llm_cache"
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "512"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+# Per-key budgets for the async client (defaults match the gemini-1.5-flash free tier)
+GEMINI_RPM_PER_KEY = float(os.getenv("GEMINI_RPM_PER_KEY", "15"))
+GEMINI_TPM_PER_KEY = float(os.getenv("GEMINI_TPM_PER_KEY", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))
+
 if not gemini_api_keys:
     raise ValueError("No Gemini API keys found. Please set GEMINI_API_KEYS in your .env file.")
 
+LLM_REQUEST_SECONDS = metrics.histogram('llm_request_seconds', 'Gemini API call time', ['client', 'outcome'])
+LLM_TOKENS = metrics.counter('llm_tokens', 'Gemini tokens used', ['kind'])
+LLM_KEY_ROTATIONS = metrics.counter('llm_key_rotations', 'Gemini calls retried on another API key')
+LLM_CACHE_LOOKUPS = metrics.counter('llm_cache_lookups', 'LLM response cache lookups', ['result'])
+
+
+class LLMCache:
+    '''
+    Two-level cache of LLM responses keyed by sha256(model + prompt): an in-process LRU in
+    front of a MongoDB collection with a TTL index and a cap on the number of entries.
+    Store errors are logged and treated as misses so the cache can never fail a call.
+    '''
+
+    # Trim the store back to max_entries every this many writes
+    TRIM_EVERY = 100
+
+    def __init__(self, collection=None, ttl=timedelta(hours=LLM_CACHE_TTL_HOURS),
+                 memory_size=LLM_CACHE_MEMORY_SIZE, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self._collection = collection
+        self._indexed = False
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = LRUCache(maxsize=memory_size)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {'memory_hits': 0, 'store_hits': 0, 'misses': 0, 'bypassed': 0}
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def _store(self):
+        if self._collection is None and MONGO_URI:
+            self._collection = get_db()[LLM_CACHE_COLLECTION]
+        if self._collection is not None and not self._indexed:
+            self._collection.create_index('expiresAt', expireAfterSeconds=0)
+            self._collection.create_index([('createdAt', ASCENDING)])
+            self._indexed = True
+        return self._collection
+
+    def get(self, key):
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] > now:
+                self.stats['memory_hits'] += 1
+                LLM_CACHE_LOOKUPS.inc(result='memory_hit')
+                return entry[0]
+        try:
+            store = self._store()
+            # The TTL monitor only runs once a minute, so expiry is checked here as well
+            doc = store.find_one({'_id': key, 'expiresAt': {'$gt': now}}) if store is not None else None
+        except Exception as e:
+            logging.warning(f"LLM cache lookup failed: {e}")
+            doc = None
+        with self._lock:
+            if doc is None:
+                self.stats['misses'] += 1
+                LLM_CACHE_LOOKUPS.inc(result='miss')
+                return None
+            self.stats['store_hits'] += 1
+            LLM_CACHE_LOOKUPS.inc(result='store_hit')
+            self._memory[key] = (doc['response'], doc['expiresAt'])
+        return doc['response']
+
+    def set(self, key, model, response):
+        now = datetime.utcnow()
+        expires = now + self.ttl
+        with self._lock:
+            self._memory[key] = (response, expires)
+            self._writes += 1
+            trim = self._writes % self.TRIM_EVERY == 0
+        try:
+            store = self._store()
+            if store is None:
+                return
+            store.replace_one({'_id': key}, {'model': model, 'response': response, 'createdAt': now,
+                                             'expiresAt': expires}, upsert=True)
+            if trim:
+                self._trim(store)
+        except Exception as e:
+            logging.warning(f"LLM cache write failed: {e}")
+
+    def _trim(self, store):
+        excess = store.estimated_document_count() - self.max_entries
+        if excess > 0:
+            oldest = [doc['_id'] for doc in store.find({}, {'_id': 1}).sort('createdAt', ASCENDING).limit(excess)]
+            store.delete_many({'_id': {'$in': oldest}})
+
+
+llm_cache = LLMCache()
+
+
+def get_cache_stats():
+    return dict(llm_cache.stats)
+
+
 def is_quota_error(e):
     msg = str(e).lower()
     return (
@@ -21,22 +141,56 @@ def is_quota_error(e):
         "rate" in msg
     )
 
-def generate_response(prompt):
+def _build_request(prompt):
+    return glm.GenerateContentRequest(
+        model=f"models/{GEMINI_MODEL}",
+        contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+    )
+
+def _record_usage(usage):
+    LLM_TOKENS.inc(usage.prompt_token_count, kind='prompt')
+    LLM_TOKENS.inc(usage.candidates_token_count, kind='output')
+
+def _response_text(response):
+    if not response.candidates:
+        raise ValueError(f"Gemini returned no candidates: {response.prompt_feedback}")
+    return "".join(part.text for part in response.candidates[0].content.parts)
+
+def _client_options(key):
+    return ClientOptions(api_key=key)
+
+# One client per key instead of the global genai.configure, which is not thread-safe
+_sync_clients = {}
+_sync_clients_lock = threading.Lock()
+
+def _sync_client(key):
+    with _sync_clients_lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options=_client_options(key))
+            _sync_clients[key] = client
+        return client
+
+def _generate_uncached(prompt):
     '''
-    Send user query to Gemini API and return response, rotating through API keys if quota/limit is reached
+    Returns (text, ok); ok is False when every key failed
     '''
     max_retries = 3
     last_error = None
-    for key in gemini_api_keys:
-        genai.configure(api_key=key)
+    for index, key in enumerate(gemini_api_keys):
+        if index > 0:
+            LLM_KEY_ROTATIONS.inc()
         for attempt in range(max_retries):
+            start = time.perf_counter()
             try:
-                model = genai.GenerativeModel(GEMINI_MODEL)
-                response = model.generate_content(prompt)
-                print(response.usage_metadata)
-                return response.text
+                response = _sync_client(key).generate_content(_build_request(prompt), timeout=GEMINI_TIMEOUT)
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, client='sync', outcome='ok')
+                _record_usage(response.usage_metadata)
+                return _response_text(response), True
             except Exception as e:
                 last_error = e
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, client='sync',
+                                            outcome='quota' if is_quota_error(e) else 'error')
                 if is_quota_error(e):
                     print(f"API key quota/limit reached for key ending with ...{key[-4:]}. Trying next key.")
                     break  # Try next key
@@ -47,4 +201,189 @@ def generate_response(prompt):
                 else:
                     print(f"Error after {max_retries} attempts with key ending ...{key[-4:]}: {e}")
                     break  # Try next key
-    return f"All API keys failed. Last error: {str(last_error)}"
\ No newline at end of file
+    return f"All API keys failed. Last error: {str(last_error)}", False
+
+def generate_response(prompt, use_cache=True):
+    '''
+    Send user query to Gemini API and return response, rotating through API keys if quota/limit is reached.
+    Responses are cached by model and prompt; pass use_cache=False to always call the API.
+    '''
+    if not (use_cache and LLM_CACHE_ENABLED):
+        llm_cache.stats['bypassed'] += 1
+        LLM_CACHE_LOOKUPS.inc(result='bypassed')
+        return _generate_uncached(prompt)[0]
+    key = LLMCache.key(GEMINI_MODEL, prompt)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+    text, ok = _generate_uncached(prompt)
+    # Failures are never cached so the next call retries the API
+    if ok:
+        llm_cache.set(key, GEMINI_MODEL, text)
+    return text
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English prose and markup
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    '''
+    Classic token bucket: holds up to capacity tokens and refills at rate tokens per second.
+    take() may drive the balance negative so that under-estimates are paid back later.
+    '''
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class _KeyState:
+    def __init__(self, key, rpm, tpm):
+        self.key = key
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.cooldown_until = 0.0
+        self.strikes = 0
+        self.client = None
+
+    def wait_time(self, tokens, now):
+        return max(self.cooldown_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+
+class AsyncGeminiClient:
+    '''
+    Async Gemini client that spreads concurrent requests over every API key. Each key has
+    request and token buckets sized from its per-minute limits; a request goes to the key
+    that can serve it soonest. Quota errors put the key on an exponential cooldown with
+    jitter, other errors are retried with jittered backoff on the next available key.
+    Bound to the event loop it is first used on; use get_async_client().
+    '''
+
+    def __init__(self, keys=None, rpm=GEMINI_RPM_PER_KEY, tpm=GEMINI_TPM_PER_KEY,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY, max_attempts=None):
+        keys = keys if keys is not None else gemini_api_keys
+        self._keys = [_KeyState(key, rpm, tpm) for key in keys]
+        self._lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.max_attempts = max_attempts or 3 * len(self._keys)
+        self.stats = {'requests': 0, 'errors': 0, 'quota_errors': 0, 'prompt_tokens': 0, 'output_tokens': 0}
+
+    async def _reserve(self, tokens):
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                # Soonest available key first, then the one with the most unused request budget
+                state = min(self._keys, key=lambda k: (k.wait_time(tokens, now), -k.requests.tokens))
+                wait = state.wait_time(tokens, now)
+                if wait <= 0:
+                    state.requests.take(1)
+                    state.tokens.take(tokens)
+                    return state
+            await asyncio.sleep(wait)
+
+    def _client(self, state):
+        if state.client is None:
+            state.client = glm.GenerativeServiceAsyncClient(client_options=_client_options(state.key))
+        return state.client
+
+    @staticmethod
+    def _backoff(strikes):
+        return min(60.0, 2 ** strikes) * (0.5 + random.random())
+
+    async def generate(self, prompt, usage_out=None):
+        '''
+        Returns (text, ok); ok is False when every attempt failed. Token counts of the
+        successful call are added to the usage_out dict when one is given.
+        '''
+        estimate = estimate_tokens(prompt)
+        last_error = None
+        previous = None
+        async with self._slots:
+            for attempt in range(self.max_attempts):
+                state = await self._reserve(estimate)
+                if previous is not None and state is not previous:
+                    LLM_KEY_ROTATIONS.inc()
+                previous = state
+                self.stats['requests'] += 1
+                start = time.perf_counter()
+                try:
+                    response = await self._client(state).generate_content(_build_request(prompt),
+                                                                          timeout=GEMINI_TIMEOUT)
+                    LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, client='async', outcome='ok')
+                    usage = response.usage_metadata
+                    _record_usage(usage)
+                    # Settle the token bucket with the real usage instead of the estimate
+                    state.tokens.take(usage.total_token_count - estimate)
+                    state.strikes = 0
+                    self.stats['prompt_tokens'] += usage.prompt_token_count
+                    self.stats['output_tokens'] += usage.candidates_token_count
+                    if usage_out is not None:
+                        usage_out['prompt_tokens'] = usage_out.get('prompt_tokens', 0) + usage.prompt_token_count
+                        usage_out['output_tokens'] = usage_out.get('output_tokens', 0) + usage.candidates_token_count
+                    return _response_text(response), True
+                except Exception as e:
+                    last_error = e
+                    self.stats['errors'] += 1
+                    LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, client='async',
+                                                outcome='quota' if is_quota_error(e) else 'error')
+                    if is_quota_error(e):
+                        self.stats['quota_errors'] += 1
+                        state.strikes += 1
+                        state.cooldown_until = time.monotonic() + self._backoff(state.strikes)
+                        logging.warning(f"Quota/limit reached for key ending ...{state.key[-4:]}, cooling down")
+                    else:
+                        logging.warning(f"Gemini attempt {attempt + 1} failed: {e}")
+                        await asyncio.sleep(self._backoff(min(attempt, 4)))
+        return f"All API keys failed. Last error: {str(last_error)}", False
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    '''
+    Return the async Gemini client bound to the running event loop, creating it on first use
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncGeminiClient()
+        _async_clients[loop] = client
+    return client
+
+
+async def generate_response_async(prompt, use_cache=True, usage_out=None):
+    '''
+    Async variant of generate_response that runs concurrently across all API keys within
+    each key's rate limits. Shares the response cache with generate_response. Pass a dict
+    as usage_out to accumulate prompt/output token counts (cache hits add nothing).
+    '''
+    if not (use_cache and LLM_CACHE_ENABLED):
+        llm_cache.stats['bypassed'] += 1
+        LLM_CACHE_LOOKUPS.inc(result='bypassed')
+        return (await get_async_client().generate(prompt, usage_out))[0]
+    key = LLMCache.key(GEMINI_MODEL, prompt)
+    # The cache store is synchronous MongoDB, so keep it off the event loop
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return cached
+    text, ok = await get_async_client().generate(prompt, usage_out)
+    if ok:
+        await asyncio.to_thread(llm_cache.set, key, GEMINI_MODEL, text)
+    return text
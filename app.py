@@ -1,20 +1,16 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from utils.clerk_auth import authenticate_and_get_user_details
 from routes.competitor import competitor_bp
-from pymongo import MongoClient
-import os
+from utils.mongo import get_db, ensure_indexes
+from utils import metrics
+import logging
 import dotenv
 
 dotenv.load_dotenv()
 
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = "competitorIQ"
 USER_PREFS_COLLECTION = "user_preferences"
 
-def get_mongo_client():
-    return MongoClient(MONGO_URI)
-
 app = Flask(__name__)
 #CORS(app, origins=["http://localhost:8080"], supports_credentials=True)
 CORS(app, origins=["https://competitor-iq-insights-ai.vercel.app"], supports_credentials=True, allow_headers=["Content-Type", "Authorization"], allowed_methods=["GET", "POST", "OPTIONS"])
@@ -22,6 +18,12 @@ CORS(app, origins=["https://competitor-iq-insights-ai.vercel.app"], supports_cre
 # Register competitor routes
 app.register_blueprint(competitor_bp)
 
+# Create required indexes once per worker at startup; the app still serves if Mongo is down
+try:
+    ensure_indexes()
+except Exception as e:
+    logging.warning(f"Could not ensure MongoDB indexes: {e}")
+
 @app.route('/login', methods=['POST', 'OPTIONS'])
 def login():
     if request.method == 'OPTIONS':
@@ -38,18 +40,20 @@ def login():
 def health():
     return jsonify({'status': 'ok'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Counts of this worker process only
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/user/preferences', methods=['GET', 'POST'])
 def user_preferences():
-    client = get_mongo_client()
-    db = client[DB_NAME]
+    db = get_db()
     collection = db[USER_PREFS_COLLECTION]
     if request.method == 'GET':
         user_id = request.args.get('userId')
         if not user_id:
-            client.close()
             return jsonify({'error': 'Missing userId parameter'}), 400
         doc = collection.find_one({'userId': user_id})
-        client.close()
         if doc:
             prefs = doc.get('preferences', {})
         else:
@@ -60,14 +64,12 @@ def user_preferences():
         user_id = data.get('userId')
         preferences = data.get('preferences')
         if not user_id or preferences is None:
-            client.close()
             return jsonify({'error': 'Missing userId or preferences'}), 400
         collection.update_one(
             {'userId': user_id},
             {'$set': {'preferences': preferences}},
             upsert=True
         )
-        client.close()
         return jsonify({'success': True}), 200
 
 if __name__ == "__main__":
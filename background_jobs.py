@@ -0,0 +1,99 @@
+import logging
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime
+from cachetools import LRUCache
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BackgroundJobQueue:
+    '''
+    In-process job queue with a fixed pool of worker threads and a bounded backlog. Jobs are
+    deduplicated by key: submitting a key that is already queued or running returns the
+    existing job. Finished jobs are kept (up to history_size) so their status can be polled.
+    Workers start on first use, so a forked web worker starts its own.
+    '''
+
+    def __init__(self, workers, max_queued, history_size=1000, name='jobs'):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = LRUCache(maxsize=history_size)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start_workers(self):
+        # Called with the lock held
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for k in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.name}-{k}", daemon=True).start()
+
+    def submit(self, key, fn, *args):
+        '''
+        Queue fn(*args) under key. Returns (job, created); raises QueueFull when the backlog is full.
+        '''
+        with self._lock:
+            self._start_workers()
+            job_id = self._active.get(key)
+            if job_id is not None:
+                return dict(self._jobs[job_id]), False
+            job = {'id': uuid.uuid4().hex, 'key': key, 'status': 'queued', 'queuedAt': datetime.utcnow(),
+                   'startedAt': None, 'finishedAt': None, 'error': None}
+            try:
+                self._queue.put_nowait((job['id'], fn, args))
+            except queue.Full:
+                raise QueueFull(f"{self.name} queue is full")
+            self._jobs[job['id']] = job
+            self._active[key] = job['id']
+            return dict(job), True
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _work(self):
+        while True:
+            job_id, fn, args = self._queue.get()
+            with self._lock:
+                job = self._jobs[job_id]
+                job['status'] = 'running'
+                job['startedAt'] = datetime.utcnow()
+            try:
+                fn(*args)
+                status, error = 'done', None
+            except Exception as e:
+                logging.exception(f"{self.name} job {job_id} failed")
+                status, error = 'failed', str(e)
+            with self._lock:
+                job.update(status=status, error=error, finishedAt=datetime.utcnow())
+                self._active.pop(job['key'], None)
+                # Keep the record visible even if newer jobs pushed it out of the history
+                self._jobs[job_id] = job
+            self._queue.task_done()
+
+
+def job_status(job):
+    '''
+    JSON-ready view of a job with queue and run times in seconds
+    '''
+    now = datetime.utcnow()
+    started, finished = job['startedAt'], job['finishedAt']
+    return {
+        'jobId': job['id'],
+        'status': job['status'],
+        'queuedAt': job['queuedAt'].isoformat() + 'Z',
+        'startedAt': started.isoformat() + 'Z' if started else None,
+        'finishedAt': finished.isoformat() + 'Z' if finished else None,
+        'queueSeconds': round(((started or now) - job['queuedAt']).total_seconds(), 3),
+        'runSeconds': round(((finished or now) - started).total_seconds(), 3) if started else None,
+        'error': job['error'],
+    }
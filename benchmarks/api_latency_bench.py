@@ -0,0 +1,95 @@
+'''
+Latency of the list and summaries endpoints with a new MongoClient per request (the old
+behaviour) versus the shared process-wide client, through the Flask test client against
+the MongoDB at MONGO_URI. Seeds a throwaway database (MONGO_DB_NAME, default
+competitorIQ_bench) and drops it afterwards.
+
+    python benchmarks/api_latency_bench.py --competitors 20 --requests 200
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MONGO_DB_NAME", "competitorIQ_bench")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pymongo import MongoClient
+from utils import mongo
+import routes.competitor as competitor_routes
+from app import app
+
+USER_ID = "bench-user"
+
+
+def seed(db, competitors):
+    db.competitors.delete_many({'userId': USER_ID})
+    now = datetime.utcnow()
+    db.competitors.insert_many([{
+        'userId': USER_ID,
+        'name': f"Competitor {i}",
+        'homepage': f"https://competitor{i}.example.com",
+        'fields': {'pricing': f"https://competitor{i}.example.com/pricing", 'custom': []},
+        'snapshots': [],
+        'summaries': [{'date': now - timedelta(days=d), 'summary': [f"Change {d} of competitor {i}"]}
+                      for d in range(10)],
+    } for i in range(competitors)])
+
+
+def per_request_client_db():
+    # What every handler did before: open a fresh client (TCP/TLS handshake + discovery)
+    client = MongoClient(mongo.MONGO_URI)
+    per_request_client_db.clients.append(client)
+    return client[mongo.DB_NAME]
+
+
+per_request_client_db.clients = []
+
+
+def measure(http, path, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = http.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        for client in per_request_client_db.clients:
+            client.close()
+        per_request_client_db.clients.clear()
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main(competitors, requests):
+    # The benchmark drops its database when done, so never point it at a real one
+    if not mongo.DB_NAME.endswith("_bench"):
+        sys.exit(f"Refusing to run against database {mongo.DB_NAME!r}; MONGO_DB_NAME must end with _bench")
+    db = mongo.get_db()
+    seed(db, competitors)
+    http = app.test_client()
+    paths = {'list': f"/api/competitors/list?userId={USER_ID}",
+             'summaries': f"/api/competitors/summaries?userId={USER_ID}"}
+    shared_get_db = competitor_routes.get_db
+    print(f"{'endpoint':<12}{'mode':<22}{'p50 ms':>10}{'p95 ms':>10}")
+    try:
+        for name, path in paths.items():
+            for mode, get_db in (("client per request", per_request_client_db), ("shared client", shared_get_db)):
+                competitor_routes.get_db = get_db
+                http.get(path)  # warm-up
+                p50, p95 = measure(http, path, requests)
+                print(f"{name:<12}{mode:<22}{p50:>10.2f}{p95:>10.2f}")
+    finally:
+        competitor_routes.get_db = shared_get_db
+        mongo.get_client().drop_database(mongo.DB_NAME)
+        mongo.close_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--competitors", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    main(args.competitors, args.requests)
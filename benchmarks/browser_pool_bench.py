@@ -0,0 +1,86 @@
+'''
+Pages/second of the old launch-per-URL fetch versus the shared BrowserPool,
+against a local static HTTP server serving trello_html.html. The pool renders with the
+"full" profile by default, like the launch-per-URL fetch, so only pooling is measured.
+
+    python benchmarks/browser_pool_bench.py --pages 40 --concurrency 4 [--profile full]
+'''
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from playwright.async_api import async_playwright
+from browser_pool import BrowserPool, RENDER_PROFILES
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    handler = functools.partial(QuietHandler, directory=ROOT)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# The fetch_html implementation before the pool: one Chromium launch per URL
+async def fetch_html_launch_per_url(url):
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        page = await browser.new_page()
+        await page.goto(url, timeout=20000)
+        html = await page.content()
+        await browser.close()
+        return html
+
+
+async def run_batch(fetch, urls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(url):
+        async with semaphore:
+            return await fetch(url)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one(url) for url in urls])
+    elapsed = time.perf_counter() - start
+    assert all(results), "empty page returned"
+    return elapsed
+
+
+async def main(pages, concurrency, profile):
+    server = start_server()
+    base = f"http://127.0.0.1:{server.server_address[1]}/trello_html.html"
+    urls = [f"{base}?page={i}" for i in range(pages)]
+
+    before = await run_batch(fetch_html_launch_per_url, urls, concurrency)
+    pool = BrowserPool(size=concurrency, profile=profile)
+    try:
+        after = await run_batch(pool.fetch_html, urls, concurrency)
+    finally:
+        await pool.close()
+    server.shutdown()
+
+    print(f"{'mode':<22}{'seconds':>10}{'pages/s':>10}")
+    print(f"{'launch per URL':<22}{before:>10.2f}{pages / before:>10.2f}")
+    print(f"{'browser pool (' + profile + ')':<22}{after:>10.2f}{pages / after:>10.2f}")
+    print(f"speedup: {before / after:.1f}x  pool stats: {pool.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--profile", choices=sorted(RENDER_PROFILES), default="full")
+    args = parser.parse_args()
+    asyncio.run(main(args.pages, args.concurrency, args.profile))
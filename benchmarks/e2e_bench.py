@@ -0,0 +1,432 @@
+'''
+End-to-end benchmark: seeds N users x M competitors x K pages, serves the pages from local
+HTTP servers (homepages recorded from trello_html.html, the rest synthetic, a share of them
+changing between runs), fakes Gemini and the mail provider with configurable latency, runs
+pipeline.main a few times and then exercises the Flask endpoints. Reports throughput,
+per-stage latency percentiles and peak memory.
+
+MongoDB is in memory (mongomock, installed separately) by default, or the MongoDB at
+MONGO_URI with --mongo local, using and dropping MONGO_DB_NAME (default competitorIQ_bench).
+
+    python benchmarks/e2e_bench.py --users 20 --competitors 5 --pages 4 --runs 2 [--json out.json]
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+os.environ.setdefault("MONGO_DB_NAME", "competitorIQ_bench")
+# Local servers need no politeness delay; export a value to measure with one
+os.environ.setdefault("CRAWL_PER_HOST_DELAY", "0")
+# Gemini is faked, but the client still reads its keys at startup
+os.environ.setdefault("GEMINI_API_KEYS", "bench-key")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+from pymongo import UpdateOne, UpdateMany, InsertOne, ReplaceOne, DeleteOne, DeleteMany
+import AiLib
+import email_outbox
+import pipeline
+import routes.competitor as competitor_routes
+from crawl_scheduler import CrawlScheduler
+from email_outbox import EmailOutbox
+from http_fetcher import TieredFetcher
+from mail_service import StubProvider
+from snapshot_store import SnapshotStore
+from utils import mongo, user_directory
+from utils.user_directory import UserDirectory, FakeClerk
+
+WORDS = ("pricing plan team board card workflow automation integration release feature update "
+         "customer enterprise security storage project roadmap template mobile calendar report "
+         "analytics support premium standard free trial seat admin api export import").split()
+
+
+class Timings:
+    '''
+    Latency samples per stage, from any thread
+    '''
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        if asyncio.iscoroutinefunction(original):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        setattr(owner, name, timed)
+
+    def report(self):
+        rows = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+            rows[stage] = {'count': len(samples), 'p50_ms': pick(0.5), 'p90_ms': pick(0.9),
+                           'p99_ms': pick(0.99), 'total_s': sum(samples)}
+        return rows
+
+
+class Site:
+    '''
+    Pages of one synthetic competitor site. Each run, every page changes with probability
+    change_rate; a changed page rewrites a few of its paragraphs.
+    '''
+
+    def __init__(self, index, pages, recorded, change_rate):
+        self.index = index
+        self.pages = pages
+        self.recorded = recorded
+        self.change_rate = change_rate
+        self._cache = {}
+
+    def version(self, page, run):
+        rng = random.Random(f"{self.index}:{page}:changes")
+        return sum(rng.random() < self.change_rate for _ in range(run))
+
+    def _paragraphs(self, page, version):
+        rng = random.Random(f"{self.index}:{page}")
+        paragraphs = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(12, 40))) for _ in range(40)]
+        for v in range(1, version + 1):
+            edit = random.Random(f"{self.index}:{page}:{v}")
+            for _ in range(3):
+                paragraphs[edit.randrange(len(paragraphs))] = f"Update {v}: " + ' '.join(
+                    edit.choice(WORDS) for _ in range(20))
+        return paragraphs
+
+    def html(self, page, run):
+        version = self.version(page, run)
+        key = (page, version)
+        if key not in self._cache:
+            paragraphs = self._paragraphs(page, version)
+            if page == 0 and self.recorded:
+                # The recorded page with this site's own paragraphs, so sites do not share bodies
+                head, sep, tail = self.recorded.partition('<body')
+                body = ''.join(f"<p>{p}</p>" for p in paragraphs[:5])
+                tag_end = tail.find('>') + 1
+                html = head + sep + tail[:tag_end] + f"<section>{body}</section>" + tail[tag_end:]
+            else:
+                items = ''.join(f"<li>{p}</li>" if k % 4 == 3 else f"<p>{p}</p>" for k, p in enumerate(paragraphs))
+                html = (f"<html><head><title>Site {self.index} page {page}</title><style>p{{margin:0}}</style>"
+                        f"<script>window.bench={page}</script></head><body><nav><a href='/'>Home</a></nav>"
+                        f"<main><h1>Site {self.index}</h1><article>{items}</article></main></body></html>")
+            self._cache[key] = (html.encode(), hashlib.sha1(html.encode()).hexdigest())
+        return self._cache[key]
+
+
+class PageServer:
+    '''
+    Serves /s<site>/p<page> for the current run on one port of several loopback addresses,
+    so the crawl sees many hosts; honours If-None-Match
+    '''
+
+    def __init__(self, sites, hosts):
+        self.sites = sites
+        self.run = 0
+        self.requests = 0
+        self.bytes = 0
+        self._servers = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                try:
+                    site, page = server.sites[int(parts[0][1:])], int(parts[1][1:])
+                except (IndexError, ValueError):
+                    self.send_error(404)
+                    return
+                body, etag = site.html(page, server.run)
+                server.requests += 1
+                if self.headers.get('If-None-Match') == f'"{etag}"':
+                    self.send_response(304)
+                    self.send_header('ETag', f'"{etag}"')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                server.bytes += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('ETag', f'"{etag}"')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        first = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = first.server_address[1]
+        self._servers.append(first)
+        self.hosts = ["127.0.0.1"]
+        for k in range(2, hosts + 1):
+            # Other loopback addresses are not configured everywhere (e.g. macOS)
+            try:
+                self._servers.append(ThreadingHTTPServer((f"127.0.0.{k}", self.port), Handler))
+                self.hosts.append(f"127.0.0.{k}")
+            except OSError:
+                break
+        for s in self._servers:
+            threading.Thread(target=s.serve_forever, daemon=True).start()
+
+    def url(self, site, page):
+        host = self.hosts[site % len(self.hosts)]
+        return f"http://{host}:{self.port}/s{site}/p{page}"
+
+    def shutdown(self):
+        for s in self._servers:
+            s.shutdown()
+
+
+def _mongomock_bulk_write(self, requests, ordered=True, **kwargs):
+    # mongomock's bulk_write does not accept the operations of current pymongo releases
+    result = SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0, deleted_count=0,
+                             upserted_count=0, upserted_ids={})
+    for index, op in enumerate(requests):
+        if isinstance(op, InsertOne):
+            self.insert_one(op._doc)
+            result.inserted_count += 1
+            continue
+        if isinstance(op, (DeleteOne, DeleteMany)):
+            delete = self.delete_one if isinstance(op, DeleteOne) else self.delete_many
+            result.deleted_count += delete(op._filter).deleted_count
+            continue
+        update = {UpdateOne: self.update_one, UpdateMany: self.update_many, ReplaceOne: self.replace_one}[type(op)]
+        r = update(op._filter, op._doc, upsert=op._upsert)
+        result.matched_count += r.matched_count
+        result.modified_count += r.modified_count
+        if r.upserted_id is not None:
+            result.upserted_count += 1
+            result.upserted_ids[index] = r.upserted_id
+    return result
+
+
+def use_in_memory_mongo():
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("--mongo memory needs mongomock (pip install mongomock); or use --mongo local")
+    mongomock.collection.Collection.bulk_write = _mongomock_bulk_write
+    client = mongomock.MongoClient()
+    # pipeline.main closes the client after each run; keep the one in-memory database alive
+    client.close = lambda: None
+    mongo.MongoClient = lambda *args, **kwargs: client
+
+
+def use_fakes(args, timings, rng):
+    def answer(prompt):
+        if 'JSON object' in prompt:
+            return json.dumps({'subject': 'Your competitor update', 'body': '<p>Competitors changed.</p>'})
+        return json.dumps([f"Change {rng.randint(0, 999)} detected"])
+
+    async def fake_generate(prompt, use_cache=True, usage_out=None):
+        start = time.perf_counter()
+        await asyncio.sleep(args.llm_latency * rng.uniform(0.5, 1.5))
+        timings.add('llm', time.perf_counter() - start)
+        text = answer(prompt)
+        if usage_out is not None:
+            usage_out['prompt_tokens'] = usage_out.get('prompt_tokens', 0) + AiLib.estimate_tokens(prompt)
+            usage_out['output_tokens'] = usage_out.get('output_tokens', 0) + AiLib.estimate_tokens(text)
+        return text
+
+    def fake_generate_sync(prompt, use_cache=True):
+        time.sleep(args.llm_latency)
+        return answer(prompt)
+
+    AiLib.generate_response = fake_generate_sync
+    AiLib.generate_response_async = pipeline.generate_response_async = fake_generate
+    competitor_routes.generate_response_async = fake_generate
+
+    http = httpx.AsyncClient()
+
+    async def browser_stand_in(url, profile=None):
+        # Plain GET plus the render time a browser would add
+        await asyncio.sleep(args.browser_latency)
+        try:
+            return (await http.get(url)).text
+        except httpx.HTTPError:
+            return ""
+
+    pipeline.fetch_html = competitor_routes.fetch_html = browser_stand_in
+    email_outbox._outbox = EmailOutbox(provider=StubProvider(delay=args.mail_latency), rate=0)
+    emails = {f"bench-user-{u}": f"bench-user-{u}@bench.local" for u in range(args.users)}
+    user_directory._directory = UserDirectory(FakeClerk(emails))
+
+    timings.wrap(CrawlScheduler, 'crawl', 'crawl')
+    timings.wrap(TieredFetcher, 'fetch_html', 'fetch')
+    timings.wrap(pipeline, 'snapshot_page', 'parse')
+    timings.wrap(SnapshotStore, 'put_pages', 'store')
+    timings.wrap(pipeline, 'diff_snapshots', 'diff')
+    timings.wrap(pipeline, 'summarize_with_gemini_async', 'summarize')
+    timings.wrap(pipeline, 'generate_user_email_content_async', 'email_render')
+    timings.wrap(EmailOutbox, 'deliver_due', 'deliver')
+
+
+def seed(db, args, server):
+    docs = []
+    for u in range(args.users):
+        for c in range(args.competitors):
+            site = (u * args.competitors + c) % len(server.sites)
+            docs.append({
+                'userId': f"bench-user-{u}",
+                'name': f"Competitor {site}",
+                'homepage': server.url(site, 0),
+                'fields': {'pricing': server.url(site, 1) if args.pages > 1 else None,
+                           'custom': [server.url(site, p) for p in range(2, args.pages)]},
+                'snapshots': [],
+                'summaries': [],
+            })
+    db.competitors.insert_many(docs)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def bench_api(http, db, args, timings, rng):
+    competitors = list(db.competitors.find({}, {'_id': 1, 'userId': 1}))
+    for _ in range(args.api_requests):
+        competitor = rng.choice(competitors)
+        competitor_id = str(competitor['_id'])
+        for stage, path in (('api_list', f"/api/competitors/list?userId={competitor['userId']}"),
+                            ('api_summaries', f"/api/competitors/summaries?userId={competitor['userId']}&limit=20"),
+                            ('api_snapshots', f"/api/competitors/{competitor_id}/snapshots")):
+            start = time.perf_counter()
+            response = http.get(path)
+            timings.add(stage, time.perf_counter() - start)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        dates = response.get_json()['snapshots']
+        if dates:
+            start = time.perf_counter()
+            response = http.get(f"/api/competitors/{competitor_id}/diff?from={dates[0]}")
+            timings.add('api_diff', time.perf_counter() - start)
+            assert response.status_code == 200, response.get_data(as_text=True)
+    # On-demand snapshots: time from the POST until the job reports done
+    for competitor in rng.sample(competitors, min(args.snapshot_jobs, len(competitors))):
+        start = time.perf_counter()
+        job = http.post(f"/api/competitors/{competitor['_id']}/snapshot").get_json()
+        while True:
+            status = http.get(f"/api/competitors/snapshot-jobs/{job['jobId']}").get_json()
+            if status['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.005)
+        timings.add('api_snapshot_job', time.perf_counter() - start)
+        assert status['status'] == 'done', status
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    if args.mongo == 'memory':
+        use_in_memory_mongo()
+    elif not mongo.DB_NAME.endswith("_bench"):
+        # The benchmark drops its database when done, so never point it at a real one
+        sys.exit(f"Refusing to run against database {mongo.DB_NAME!r}; MONGO_DB_NAME must end with _bench")
+    # Imported only now since importing the app creates the MongoDB indexes
+    from app import app
+    if args.tracemalloc:
+        tracemalloc.start()
+    with open(os.path.join(ROOT, "trello_html.html"), encoding="utf-8") as f:
+        recorded = None if args.synthetic_only else f.read()
+    distinct = args.sites or args.users * args.competitors
+    sites = [Site(s, args.pages, recorded, args.change_rate) for s in range(distinct)]
+    server = PageServer(sites, args.hosts)
+    timings = Timings()
+    use_fakes(args, timings, rng)
+    db = mongo.get_db()
+    db.client.drop_database(mongo.DB_NAME)
+    seed(db, args, server)
+    tracked = args.users * args.competitors
+    print(f"{args.users} users x {args.competitors} competitors x {args.pages} pages over {distinct} sites "
+          f"on {len(server.hosts)} hosts, mongo={args.mongo}")
+
+    runs = []
+    try:
+        for r in range(args.runs):
+            server.run = r
+            requests_before, bytes_before = server.requests, server.bytes
+            start = time.perf_counter()
+            pipeline.main(run_id=f"bench-{r}")
+            elapsed = time.perf_counter() - start
+            timings.add('run', elapsed)
+            runs.append({'run': r, 'seconds': elapsed, 'competitors_per_s': tracked / elapsed,
+                         'pages_per_s': tracked * args.pages / elapsed,
+                         'http_requests': server.requests - requests_before,
+                         'http_mb': (server.bytes - bytes_before) / 1e6})
+        http = app.test_client()
+        bench_api(http, mongo.get_db(), args, timings, rng)
+        sent = len(email_outbox.get_email_outbox().provider.sent)
+    finally:
+        server.shutdown()
+        mongo.get_client().drop_database(mongo.DB_NAME)
+        mongo.close_client()
+
+    memory = {'peak_rss_mb': peak_rss_mb()}
+    if args.tracemalloc:
+        memory['peak_python_heap_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+    stages = timings.report()
+    print(f"\n{'run':<6}{'seconds':>10}{'comp/s':>10}{'pages/s':>10}{'requests':>10}{'MB':>8}")
+    for run in runs:
+        print(f"{run['run']:<6}{run['seconds']:>10.2f}{run['competitors_per_s']:>10.1f}{run['pages_per_s']:>10.1f}"
+              f"{run['http_requests']:>10}{run['http_mb']:>8.1f}")
+    print(f"\n{'stage':<18}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'total s':>10}")
+    for stage, row in stages.items():
+        print(f"{stage:<18}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p90_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{row['total_s']:>10.2f}")
+    print(f"\nemails sent: {sent}  " + "  ".join(f"{k}: {v:.1f}" for k, v in memory.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'params': vars(args), 'runs': runs, 'stages': stages, 'memory': memory, 'emails_sent': sent},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--competitors", type=int, default=5, help="competitors per user")
+    parser.add_argument("--pages", type=int, default=4, help="tracked pages per competitor")
+    parser.add_argument("--sites", type=int, default=0,
+                        help="distinct sites (default one per competitor; fewer makes users share competitors)")
+    parser.add_argument("--runs", type=int, default=2, help="pipeline runs; pages change between runs")
+    parser.add_argument("--change-rate", type=float, default=0.3, help="share of pages changing per run")
+    parser.add_argument("--hosts", type=int, default=8, help="loopback addresses to spread sites over")
+    parser.add_argument("--synthetic-only", action="store_true", help="do not serve the recorded homepage")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per fake Gemini call")
+    parser.add_argument("--browser-latency", type=float, default=1.0, help="extra seconds per browser fetch")
+    parser.add_argument("--mail-latency", type=float, default=0.2, help="seconds per mail provider call")
+    parser.add_argument("--api-requests", type=int, default=50)
+    parser.add_argument("--snapshot-jobs", type=int, default=5)
+    parser.add_argument("--mongo", choices=["memory", "local"], default="memory")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    main(parser.parse_args())
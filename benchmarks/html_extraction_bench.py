@@ -0,0 +1,95 @@
+'''
+Paragraph extraction time of the reference preprocess pipeline (remove_unwanted_tags +
+extract_paragraphs, two html.parser parses and a per-block subtree scan) versus the
+single-pass engine behind preprocess_html, per parser backend, on trello_html.html, two
+synthetic div-soup pages and any extra HTML files given on the command line. Before timing,
+a set of small edge-case fragments is checked for identical output.
+
+    python benchmarks/html_extraction_bench.py --repeat 5 [page.html ...]
+'''
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from html_processing_library import remove_unwanted_tags, extract_paragraphs, normalize_text, preprocess_html
+
+
+# Edge cases where the single pass must match the serialize/reparse of the reference:
+# text that a removed tag split in two is read back as one string, without a space
+IDENTITY_CASES = [
+    "<p>foo<script>x</script>bar</p>",
+    "<p>foo<style>p {}</style>bar</p>",
+    "<p>foo<noscript>x</noscript>bar<iframe></iframe>baz</p>",
+    "<p>foo<meta charset='utf-8'><link rel='x'>bar</p>",
+    "<p>foo <script>x</script> bar</p>",
+    "<p>foo<!--note--><script>x</script>bar</p>",
+    "<p>foo<b>x</b><script>y</script>bar</p>",
+    "<div>a<p>foo<script>x</script></p>bar</div>",
+    "<li>a<script></script><script></script>b<br>c</li>",
+]
+
+
+def reference_preprocess(raw_html):
+    paragraphs = extract_paragraphs(remove_unwanted_tags(raw_html))
+    return [normalize_text(p) for p in paragraphs if p.strip()]
+
+
+def available_parsers():
+    parsers = ["html.parser"]
+    try:
+        import lxml  # noqa: F401
+        parsers.append("lxml")
+    except ImportError:
+        pass
+    return parsers
+
+
+def load_pages(paths):
+    pages = {}
+    for path in [os.path.join(ROOT, "trello_html.html")] + paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            pages[os.path.basename(path)] = f.read()
+    # Deep nesting is the worst case for the per-block find() leaf test
+    pages["synthetic-deep"] = "<div>" * 1500 + "<p>leaf text</p>" * 20 + "</div>" * 1500
+    pages["synthetic-div-soup"] = ("<div>" * 25 + "<p>card text</p><li>item</li>" + "</div>" * 25) * 400
+    return pages
+
+
+def timed(fn, raw_html, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(raw_html)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(paths, repeat):
+    # Deeply nested trees recurse in BeautifulSoup's own serializer used by the reference
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    parsers = available_parsers()
+    mismatches = [case for case in IDENTITY_CASES if preprocess_html(case) != reference_preprocess(case)]
+    print(f"edge cases identical: {len(IDENTITY_CASES) - len(mismatches)}/{len(IDENTITY_CASES)}")
+    for case in mismatches:
+        print(f"  differs: {case!r} -> {preprocess_html(case)} (reference {reference_preprocess(case)})")
+    header = f"{'page':<22}{'KB':>8}{'reference ms':>14}" + "".join(f"{p + ' ms':>16}{'identical':>11}" for p in parsers)
+    print(header)
+    for name, raw_html in load_pages(paths).items():
+        ref_time, expected = timed(reference_preprocess, raw_html, repeat)
+        row = f"{name[:21]:<22}{len(raw_html.encode()) / 1024:>8.0f}{ref_time * 1000:>14.1f}"
+        for parser in parsers:
+            elapsed, result = timed(lambda html: preprocess_html(html, parser=parser), raw_html, repeat)
+            row += f"{elapsed * 1000:>16.1f}{str(result == expected):>11}"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="*", help="extra HTML files to include")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.pages, args.repeat)
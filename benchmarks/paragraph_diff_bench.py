@@ -0,0 +1,136 @@
+'''
+Paragraph diff time of difflib.unified_diff versus the patience diff behind diff_paragraphs
+on synthetic pages of growing size, after an equivalence check on random paragraph lists:
+the patience diff must group its edits into the same hunks, with the same headers, as
+difflib would for the same edits, and must match difflib.unified_diff line for line
+whenever both find the same edits.
+
+    python benchmarks/paragraph_diff_bench.py --cases 3000 --repeat 3
+'''
+import argparse
+import difflib
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from paragraph_diff import diff_paragraph_lists, _hash_lines, _edit_script
+
+
+def script_opcodes(script):
+    '''
+    SequenceMatcher-style opcodes for an edit script without moves
+    '''
+    opcodes = []
+    i = j = k = 0
+    while k < len(script):
+        start = k
+        if script[k][0] == ' ':
+            while k < len(script) and script[k][0] == ' ':
+                k += 1
+            opcodes.append(('equal', i, i + k - start, j, j + k - start))
+            i, j = i + k - start, j + k - start
+            continue
+        while k < len(script) and script[k][0] != ' ':
+            k += 1
+        deleted = sum(1 for op, _, _ in script[start:k] if op == '-')
+        inserted = k - start - deleted
+        tag = 'replace' if deleted and inserted else 'delete' if deleted else 'insert'
+        opcodes.append((tag, i, i + deleted, j, j + inserted))
+        i, j = i + deleted, j + inserted
+    return opcodes
+
+
+def unified_from_opcodes(opcodes, a, b, n):
+    '''
+    difflib.unified_diff's output for the given opcodes instead of its own matcher's
+    '''
+    matcher = difflib.SequenceMatcher(None, a, b)
+    matcher.get_opcodes = lambda: opcodes
+    lines = []
+    for group in matcher.get_grouped_opcodes(n):
+        if not lines:
+            lines = ['--- \n', '+++ \n']
+        first, last = group[0], group[-1]
+        lines.append(f"@@ -{difflib._format_range_unified(first[1], last[2])} "
+                     f"+{difflib._format_range_unified(first[3], last[4])} @@\n")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines.extend(' ' + line for line in a[i1:i2])
+                continue
+            lines.extend('-' + line for line in a[i1:i2])
+            lines.extend('+' + line for line in b[j1:j2])
+    return lines
+
+
+def random_pair(rng):
+    a = [f"p{rng.randrange(12)}" for _ in range(rng.randrange(0, 40))]
+    b = list(a)
+    for _ in range(rng.randrange(1, 6)):
+        k = rng.randrange(len(b) + 1)
+        if b and rng.random() < 0.5:
+            del b[min(k, len(b) - 1)]
+        else:
+            b.insert(k, f"p{rng.randrange(12)}")
+    return a, b
+
+
+def check_equivalence(cases, seed=0):
+    rng = random.Random(seed)
+    grouped = same_edits = identical = 0
+    failures = []
+    for _ in range(cases):
+        a, b = random_pair(rng)
+        n = rng.choice((0, 1, 2, 3))
+        lines, _ = diff_paragraph_lists(a, b, n=n, detect_moves=False)
+        opcodes = script_opcodes(_edit_script(*_hash_lines(a, b)))
+        if lines == unified_from_opcodes(opcodes, a, b, n):
+            grouped += 1
+        else:
+            failures.append((a, b, n))
+        if difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes() == opcodes:
+            same_edits += 1
+            identical += lines == list(difflib.unified_diff(a, b, n=n))
+    return grouped, same_edits, identical, failures
+
+
+def synthetic_page(rng, size):
+    return [f"Paragraph {rng.randrange(size * 4)} about plans, pricing and releases." for _ in range(size)]
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(cases, repeat):
+    grouped, same_edits, identical, failures = check_equivalence(cases)
+    print(f"hunks as difflib groups them: {grouped}/{cases}")
+    print(f"identical to difflib.unified_diff where both find the same edits: {identical}/{same_edits}")
+    for a, b, n in failures[:5]:
+        print(f"  differs: n={n} a={a} b={b}")
+    rng = random.Random(1)
+    print(f"{'paragraphs':>10}{'difflib ms':>12}{'patience ms':>13}")
+    for size in (100, 1000, 5000):
+        a = synthetic_page(rng, size)
+        b = list(a)
+        for _ in range(size // 20):
+            b[rng.randrange(size)] = f"Changed paragraph {rng.random()}"
+        ref = timed(lambda: list(difflib.unified_diff(a, b, n=3)), repeat)
+        ours = timed(lambda: diff_paragraph_lists(a, b, n=3, detect_moves=False), repeat)
+        print(f"{size:>10}{ref * 1000:>12.1f}{ours * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=3000, help="random paragraph lists to check")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.cases, args.repeat)
@@ -0,0 +1,165 @@
+'''
+Latency and bandwidth per browser render profile (full, lean, static) against a local
+server whose pages carry images, fonts, a video, a stylesheet, an app script that adds
+text, and an analytics script that keeps polling. The analytics script is served from
+"localhost" and the pages from 127.0.0.1, so the lean profile blocks it as a tracker host.
+
+    python benchmarks/render_profile_bench.py --pages 20 --concurrency 4
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["BROWSER_BLOCKED_HOSTS"] = ",".join(filter(None, [os.getenv("BROWSER_BLOCKED_HOSTS"), "localhost"]))
+
+from browser_pool import BrowserPool, RENDER_PROFILES
+from utils import metrics
+
+# kind -> (content type, bytes, seconds before the response)
+ASSETS = {
+    'image': ('image/jpeg', 150_000, 0.05),
+    'font': ('font/woff2', 80_000, 0.05),
+    'video': ('video/mp4', 2_000_000, 0.2),
+    'css': ('text/css', 20_000, 0.02),
+}
+APP_SCRIPT = b"document.addEventListener('DOMContentLoaded', function () {" \
+             b"var p = document.createElement('p'); p.textContent = 'Rendered by JavaScript';" \
+             b"document.body.appendChild(p); });"
+TRACKER_SCRIPT = b"setInterval(function () { fetch('/collect?t=' + Date.now()); }, 300);"
+
+
+def page_html(index, port, images):
+    paragraphs = ''.join(f"<p>Paragraph {k} of page {index}: plans, pricing and release notes.</p>"
+                         for k in range(30))
+    imgs = ''.join(f"<img src='/asset/image/{index}-{k}.jpg'>" for k in range(images))
+    return (f"<html><head><link rel='stylesheet' href='/asset/css/site.css'>"
+            f"<style>@font-face {{font-family: Brand; src: url('/asset/font/brand.woff2');}} body {{font-family: Brand}}</style>"
+            f"<script src='/app.js'></script>"
+            f"<script src='http://localhost:{port}/analytics.js'></script></head>"
+            f"<body><h1>Page {index}</h1>{paragraphs}{imgs}"
+            f"<video src='/asset/video/{index}.mp4' preload='auto'></video></body></html>").encode()
+
+
+class Server:
+    def __init__(self, images):
+        self.bytes = Counter()
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if parts[0] == 'page':
+                    kind, content_type, body = 'document', 'text/html', page_html(parts[1], server.port, images)
+                elif parts[0] == 'app.js':
+                    kind, content_type, body = 'script', 'application/javascript', APP_SCRIPT
+                elif parts[0] == 'analytics.js':
+                    kind, content_type, body = 'tracker', 'application/javascript', TRACKER_SCRIPT
+                elif parts[0] == 'collect':
+                    kind, content_type, body = 'tracker', 'text/plain', b'ok'
+                elif parts[0] == 'asset' and parts[1] in ASSETS:
+                    content_type, size, delay = ASSETS[parts[1]]
+                    time.sleep(delay)
+                    kind, body = parts[1], b'\0' * size
+                else:
+                    self.send_error(404)
+                    return
+                with server._lock:
+                    server.requests[kind] += 1
+                    server.bytes[kind] += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Aborted media downloads
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def take(self):
+        with self._lock:
+            counts, sizes = self.requests, self.bytes
+            self.requests, self.bytes = Counter(), Counter()
+        return counts, sizes
+
+
+def blocked_requests(profile):
+    return metrics.registry.snapshot().get('browser_requests', {}).get((profile, 'blocked'), 0)
+
+
+async def run_profile(profile, urls, concurrency, server):
+    pool = BrowserPool(size=concurrency, profile=profile)
+    semaphore = asyncio.Semaphore(concurrency)
+    timings, js_text = [], 0
+
+    async def one(url):
+        nonlocal js_text
+        async with semaphore:
+            start = time.perf_counter()
+            html = await pool.fetch_html(url)
+            timings.append((time.perf_counter() - start) * 1000)
+            js_text += 'Rendered by JavaScript' in html
+
+    try:
+        # Warm up: launch Chromium before timing
+        await pool.fetch_html(urls[0])
+        await asyncio.sleep(0.5)
+        server.take()
+        blocked_before = blocked_requests(profile)
+        start = time.perf_counter()
+        await asyncio.gather(*[one(url) for url in urls])
+        elapsed = time.perf_counter() - start
+    finally:
+        await pool.close()
+    # Let aborted and in-flight asset responses finish before reading the counters
+    await asyncio.sleep(0.5)
+    counts, sizes = server.take()
+    timings.sort()
+    return {'elapsed': elapsed, 'p50': statistics.median(timings),
+            'p95': timings[max(0, int(len(timings) * 0.95) - 1)], 'js_text': js_text,
+            'counts': counts, 'sizes': sizes, 'blocked': blocked_requests(profile) - blocked_before}
+
+
+async def main(pages, concurrency, images):
+    server = Server(images)
+    urls = [f"http://127.0.0.1:{server.port}/page/{i}" for i in range(pages)]
+    print(f"{'profile':<10}{'pages/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'requests':>10}{'MB':>8}"
+          f"{'blocked':>9}{'JS text':>9}")
+    for profile in RENDER_PROFILES:
+        r = await run_profile(profile, urls, concurrency, server)
+        counts, sizes = r['counts'], r['sizes']
+        js_text = f"{r['js_text']}/{pages}"
+        print(f"{profile:<10}{pages / r['elapsed']:>9.2f}{r['p50']:>9.0f}{r['p95']:>9.0f}{sum(counts.values()):>10}"
+              f"{sum(sizes.values()) / 1e6:>8.1f}{r['blocked']:>9}{js_text:>9}")
+        print(f"{'':<10}served: " + ", ".join(f"{kind} {counts[kind]} ({sizes[kind] / 1e6:.1f} MB)"
+                                             for kind in sorted(counts)))
+    server.httpd.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--images", type=int, default=20, help="images per page")
+    args = parser.parse_args()
+    asyncio.run(main(args.pages, args.concurrency, args.images))
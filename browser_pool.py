@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from utils import metrics
+import dotenv
+
+dotenv.load_dotenv()
+
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "4"))
+# Recycle a context (and its page) after this many navigations
+BROWSER_MAX_PAGES_PER_CONTEXT = int(os.getenv("BROWSER_MAX_PAGES_PER_CONTEXT", "25"))
+# Relaunch Chromium after this many navigations to keep its memory in check
+BROWSER_MAX_PAGES_PER_BROWSER = int(os.getenv("BROWSER_MAX_PAGES_PER_BROWSER", "500"))
+PAGE_TIMEOUT_MS = 20000
+# Render profile of crawls: "lean" aborts images, media, fonts and tracker requests and stops
+# at DOMContentLoaded plus a capped wait for network idle; "full" loads everything like a user
+BROWSER_RENDER_PROFILE = os.getenv("BROWSER_RENDER_PROFILE", "lean")
+# Longest wait for network idle after DOMContentLoaded in the lean profile
+BROWSER_NETWORK_IDLE_MS = int(os.getenv("BROWSER_NETWORK_IDLE_MS", "2000"))
+# Requests to these hosts and their subdomains are aborted by the lean and static profiles
+BROWSER_BLOCKED_HOSTS = [host.strip() for host in os.getenv(
+    "BROWSER_BLOCKED_HOSTS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,googlesyndication.com,facebook.net,"
+    "hotjar.com,segment.io,segment.com,mixpanel.com,amplitude.com,clarity.ms,fullstory.com,"
+    "heapanalytics.com,hs-analytics.net,hs-scripts.com,intercom.io,newrelic.com,nr-data.net,sentry.io"
+).split(",") if host.strip()]
+
+BROWSER_RENDER_SECONDS = metrics.histogram('browser_render_seconds', 'Browser navigation and render time',
+                                           ['profile'])
+BROWSER_REQUESTS = metrics.counter('browser_requests', 'Requests made by rendered pages', ['profile', 'result'])
+
+
+class RenderProfile:
+    '''
+    How pages are rendered: resource types and hosts whose requests are aborted (or every
+    request but documents), the load state navigation waits for, an optional capped wait
+    for network idle after it, and whether JavaScript runs
+    '''
+
+    def __init__(self, name, blocked_types=(), blocked_hosts=(), wait_until='load', idle_ms=0,
+                 javascript=True, documents_only=False):
+        self.name = name
+        self.blocked_types = frozenset(blocked_types)
+        self.blocked_hosts = tuple(blocked_hosts)
+        self.wait_until = wait_until
+        self.idle_ms = idle_ms
+        self.javascript = javascript
+        self.documents_only = documents_only
+
+    @property
+    def intercepts(self):
+        return bool(self.blocked_types or self.blocked_hosts or self.documents_only)
+
+    def blocks(self, resource_type, url):
+        if self.documents_only:
+            return resource_type != 'document'
+        if resource_type in self.blocked_types:
+            return True
+        host = (urlsplit(url).hostname or '').lower()
+        return any(host == blocked or host.endswith('.' + blocked) for blocked in self.blocked_hosts)
+
+
+# Only text is read from rendered pages, so these are never needed
+HEAVY_RESOURCE_TYPES = ('image', 'media', 'font')
+
+RENDER_PROFILES = {
+    'full': RenderProfile('full'),
+    'lean': RenderProfile('lean', HEAVY_RESOURCE_TYPES, BROWSER_BLOCKED_HOSTS, 'domcontentloaded',
+                          BROWSER_NETWORK_IDLE_MS),
+    # Pages known to be static: no JavaScript, and nothing but the documents is fetched
+    'static': RenderProfile('static', wait_until='domcontentloaded', javascript=False, documents_only=True),
+}
+
+
+class _BrowserHandle:
+    def __init__(self, browser):
+        self.browser = browser
+        self.uses = 0
+        self.active = 0
+        self.retired = False
+
+    def healthy(self):
+        return not self.retired and self.browser.is_connected()
+
+
+class _PooledPage:
+    def __init__(self, handle, context, page, profile):
+        self.handle = handle
+        self.context = context
+        self.page = page
+        self.profile = profile
+        self.uses = 0
+
+    def healthy(self, max_uses):
+        return (
+            self.handle.healthy()
+            and not self.page.is_closed()
+            and self.uses < max_uses
+        )
+
+
+class BrowserPool:
+    '''
+    One long-lived Chromium per event loop with a bounded pool of reusable contexts/pages.
+    Contexts are recycled after max_pages_per_context navigations or on any error, and the
+    browser is relaunched after max_pages_per_browser navigations or when it disconnects.
+    Pages render with the pool's profile unless fetch_html is given another one; idle
+    contexts are kept per profile since JavaScript and request blocking are set per context.
+    '''
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_pages_per_context=BROWSER_MAX_PAGES_PER_CONTEXT,
+                 max_pages_per_browser=BROWSER_MAX_PAGES_PER_BROWSER, profile=BROWSER_RENDER_PROFILE):
+        if profile not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile {profile!r}, expected one of {sorted(RENDER_PROFILES)}")
+        self.size = size
+        self.max_pages_per_context = max_pages_per_context
+        self.max_pages_per_browser = max_pages_per_browser
+        self.profile = RENDER_PROFILES[profile]
+        self._playwright = None
+        self._handle = None
+        self._idle = {}
+        self._slots = asyncio.Semaphore(size)
+        self._lock = asyncio.Lock()
+        self._closed = False
+        self.stats = {'pages': 0, 'errors': 0, 'browser_launches': 0, 'contexts_created': 0}
+
+    async def _current_handle(self):
+        async with self._lock:
+            if self._closed:
+                raise RuntimeError("Browser pool is closed")
+            handle = self._handle
+            if handle is not None and handle.healthy() and handle.uses < self.max_pages_per_browser:
+                return handle
+            if handle is not None:
+                handle.retired = True
+                await self._maybe_close_browser(handle)
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            browser = await self._playwright.chromium.launch(headless=True)
+            self._handle = _BrowserHandle(browser)
+            self.stats['browser_launches'] += 1
+            logging.info(f"Launched pooled Chromium (launch #{self.stats['browser_launches']})")
+            return self._handle
+
+    async def _maybe_close_browser(self, handle):
+        # A retired browser is closed once its last in-flight page is released
+        if handle.retired and handle.active == 0:
+            try:
+                await handle.browser.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    async def _new_context(browser, profile):
+        if not profile.intercepts:
+            return await browser.new_context(java_script_enabled=profile.javascript)
+        # Service workers would fetch past the route handler
+        context = await browser.new_context(java_script_enabled=profile.javascript, service_workers='block')
+
+        async def route(route):
+            request = route.request
+            if profile.blocks(request.resource_type, request.url):
+                BROWSER_REQUESTS.inc(profile=profile.name, result='blocked')
+                await route.abort()
+            else:
+                BROWSER_REQUESTS.inc(profile=profile.name, result='allowed')
+                await route.continue_()
+
+        await context.route('**/*', route)
+        return context
+
+    async def _acquire_page(self, profile):
+        idle = self._idle.setdefault(profile.name, [])
+        while idle:
+            pooled = idle.pop()
+            if (pooled.healthy(self.max_pages_per_context) and pooled.handle is self._handle
+                    and pooled.handle.uses < self.max_pages_per_browser):
+                pooled.handle.active += 1
+                return pooled
+            await self._discard(pooled)
+        handle = await self._current_handle()
+        handle.active += 1
+        try:
+            context = await self._new_context(handle.browser, profile)
+            page = await context.new_page()
+        except Exception:
+            handle.active -= 1
+            raise
+        self.stats['contexts_created'] += 1
+        return _PooledPage(handle, context, page, profile)
+
+    async def _release_page(self, pooled, reusable):
+        handle = pooled.handle
+        handle.active -= 1
+        if reusable and not self._closed and pooled.healthy(self.max_pages_per_context):
+            self._idle.setdefault(pooled.profile.name, []).append(pooled)
+        else:
+            await self._discard(pooled)
+        await self._maybe_close_browser(handle)
+
+    async def _discard(self, pooled):
+        try:
+            await pooled.context.close()
+        except Exception:
+            pass
+
+    async def fetch_html(self, url, timeout=PAGE_TIMEOUT_MS, profile=None):
+        '''
+        Rendered HTML of url, with the named render profile or the pool's
+        '''
+        profile = RENDER_PROFILES[profile] if profile else self.profile
+        async with self._slots:
+            pooled = await self._acquire_page(profile)
+            pooled.uses += 1
+            pooled.handle.uses += 1
+            self.stats['pages'] += 1
+            reusable = False
+            start = time.perf_counter()
+            try:
+                await pooled.page.goto(url, timeout=timeout, wait_until=profile.wait_until)
+                if profile.idle_ms:
+                    try:
+                        await pooled.page.wait_for_load_state('networkidle', timeout=profile.idle_ms)
+                    except PlaywrightTimeoutError:
+                        # Pages that keep polling never go idle; take what has rendered by now
+                        pass
+                html = await pooled.page.content()
+                BROWSER_RENDER_SECONDS.observe(time.perf_counter() - start, profile=profile.name)
+                reusable = True
+                return html
+            except Exception:
+                self.stats['errors'] += 1
+                if not pooled.handle.browser.is_connected():
+                    logging.warning("Pooled Chromium disconnected, it will be relaunched")
+                    pooled.handle.retired = True
+                raise
+            finally:
+                await self._release_page(pooled, reusable)
+
+    async def close(self):
+        async with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+            for pages in idle.values():
+                for pooled in pages:
+                    await self._discard(pooled)
+            if self._handle is not None:
+                try:
+                    await self._handle.browser.close()
+                except Exception:
+                    pass
+                self._handle = None
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_browser_pool():
+    '''
+    Return the browser pool bound to the running event loop, creating it on first use
+    '''
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None or pool._closed:
+        pool = BrowserPool()
+        _pools[loop] = pool
+    return pool
+
+
+async def close_browser_pool():
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+# Process-wide background loop so synchronous callers (Flask handlers, the pipeline) share one
+# browser instead of creating a new loop - and a new Chromium - per asyncio.run call.
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _get_shared_loop():
+    global _loop, _loop_pid
+    with _loop_lock:
+        # Re-create after fork (e.g. gunicorn workers) since the loop thread does not survive it
+        if _loop is None or _loop_pid != os.getpid() or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="browser-pool-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coro, timeout=None):
+    '''
+    Run a coroutine on the shared browser loop and block until it finishes.
+    Must not be called from the shared loop itself.
+    '''
+    future = asyncio.run_coroutine_threadsafe(coro, _get_shared_loop())
+    return future.result(timeout)
+
+
+def shutdown():
+    global _loop
+    with _loop_lock:
+        loop = _loop if _loop_pid == os.getpid() else None
+        _loop = None
+    if loop is None or loop.is_closed():
+        return
+    asyncio.run_coroutine_threadsafe(close_browser_pool(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
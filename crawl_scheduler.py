@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import time
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import dotenv
+
+dotenv.load_dotenv()
+
+CRAWL_MAX_CONCURRENCY = int(os.getenv("CRAWL_MAX_CONCURRENCY", "8"))
+CRAWL_PER_HOST_CONCURRENCY = int(os.getenv("CRAWL_PER_HOST_CONCURRENCY", "2"))
+# Minimum seconds between two request starts against the same host
+CRAWL_PER_HOST_DELAY = float(os.getenv("CRAWL_PER_HOST_DELAY", "1.0"))
+
+
+# Query parameters that only carry attribution and never change the rendered page
+TRACKING_PARAMS = {'gclid', 'fbclid', 'msclkid', 'dclid', 'yclid', 'mc_cid', 'mc_eid', '_hsenc', '_hsmi',
+                   'igshid', 'ref', 'ref_src'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def host_of(url):
+    try:
+        return (urlparse(url).hostname or '').lower()
+    except ValueError:
+        return ''
+
+
+def normalize_url(url):
+    '''
+    Canonical form of a URL used as the run-level fetch key: lowercase scheme and host,
+    default port, fragment, trailing slash and tracking query params removed, remaining
+    params sorted. A URL that does not parse (e.g. an out-of-range port) is its own key.
+    '''
+    try:
+        parts = urlparse(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    netloc = host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{port}"
+    if parts.username:
+        netloc = f"{parts.username}{':' + parts.password if parts.password else ''}@{netloc}"
+    path = parts.path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS]
+    return urlunparse((scheme, netloc, path, parts.params, urlencode(sorted(query)), ''))
+
+
+class _HostLimiter:
+    def __init__(self, concurrency, delay):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self.lock = asyncio.Lock()
+        self.next_start = 0.0
+
+    async def wait_turn(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class CrawlScheduler:
+    '''
+    Fetches a batch of URLs concurrently with a global concurrency cap plus per-host
+    concurrency and request spacing. fetch is an async callable url -> html.
+    URLs are deduplicated by normalize_url, and results are cached for the lifetime of the
+    scheduler, so one instance per pipeline run renders every page once.
+    '''
+
+    def __init__(self, fetch, max_concurrency=CRAWL_MAX_CONCURRENCY,
+                 per_host_concurrency=CRAWL_PER_HOST_CONCURRENCY, per_host_delay=CRAWL_PER_HOST_DELAY):
+        self.fetch = fetch
+        self.max_concurrency = max_concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_delay = per_host_delay
+        self._hosts = {}
+        self._cache = {}
+        self.stats = {'requested': 0, 'fetched': 0, 'saved': 0}
+
+    def _limiter(self, host):
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            limiter = _HostLimiter(self.per_host_concurrency, self.per_host_delay)
+            self._hosts[host] = limiter
+        return limiter
+
+    async def crawl(self, urls):
+        '''
+        Fetch every distinct page once and return a dict of url -> html ('' on failure) for
+        every URL passed in, including duplicates that only differ after normalization
+        '''
+        urls = [u for u in urls if u]
+        keys = {url: normalize_url(url) for url in urls}
+        pending = {}
+        for url in urls:
+            key = keys[url]
+            if key not in self._cache and key not in pending:
+                pending[key] = url
+        global_slots = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(key, url):
+            limiter = self._limiter(host_of(url))
+            # Take the host slot first so a busy host does not hold global slots while waiting
+            async with limiter.semaphore:
+                await limiter.wait_turn()
+                async with global_slots:
+                    try:
+                        self._cache[key] = await self.fetch(url)
+                    except Exception as e:
+                        logging.warning(f"Failed to crawl {url}: {e}")
+                        self._cache[key] = ""
+
+        start = time.monotonic()
+        await asyncio.gather(*[run(key, url) for key, url in pending.items()])
+        self.stats['requested'] += len(urls)
+        self.stats['fetched'] += len(pending)
+        self.stats['saved'] += len(urls) - len(pending)
+        logging.info(f"Crawled {len(pending)} URLs across {len(self._hosts)} hosts in {time.monotonic() - start:.1f}s "
+                     f"({len(urls)} requested, {len(urls) - len(pending)} fetches saved by dedup)")
+        return {url: self._cache[keys[url]] for url in urls}
@@ -0,0 +1,249 @@
+'''
+Email outbox: the pipeline enqueues rendered emails into the email_outbox collection and a
+delivery worker sends them. Run the worker on its own to retry pending emails:
+
+    python email_outbox.py [--watch]
+'''
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+from mail_service import get_email_provider, EMAIL_SEND_SECONDS
+from utils import metrics
+from utils.mongo import get_db, close_client, ensure_indexes
+import dotenv
+
+dotenv.load_dotenv()
+
+EMAIL_OUTBOX_COLLECTION = "email_outbox"
+# Provider calls in flight at once
+EMAIL_SEND_CONCURRENCY = int(os.getenv("EMAIL_SEND_CONCURRENCY", "4"))
+# Provider calls per second (Resend allows 2 by default)
+EMAIL_RATE_PER_SECOND = float(os.getenv("EMAIL_RATE_PER_SECOND", "2"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+# Retry n waits about EMAIL_RETRY_BASE_SECONDS * 2^(n-1)
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv("EMAIL_RETRY_BASE_SECONDS", "30"))
+# A message claimed by a worker that died is sent again after this long
+EMAIL_CLAIM_SECONDS = int(os.getenv("EMAIL_CLAIM_SECONDS", "300"))
+
+EMAILS = metrics.counter('emails', 'Outbox messages by delivery result', ['result'])
+
+
+class _RateLimiter:
+    '''
+    Spaces calls at least 1 / rate seconds apart
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class EmailOutbox:
+    '''
+    Outbox documents: {_id, to, subject, html, userId, runId, status: pending|sending|sent|failed,
+    attempts, nextAttemptAt, batchKey, providerId, lastError, createdAt, sentAt}. Enqueueing is
+    idempotent per _id, so a retried run never queues the same email twice.
+    '''
+
+    def __init__(self, collection=None, provider=None, concurrency=EMAIL_SEND_CONCURRENCY,
+                 rate=EMAIL_RATE_PER_SECOND, max_attempts=EMAIL_MAX_ATTEMPTS):
+        self._collection = collection
+        self.provider = provider or get_email_provider()
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_attempts = max_attempts
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'provider_calls': 0}
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_db()[EMAIL_OUTBOX_COLLECTION]
+        return self._collection
+
+    def enqueue(self, messages):
+        '''
+        Queue messages ({'_id', 'to', 'subject', 'html', ...}); returns how many were new
+        '''
+        now = datetime.utcnow()
+        ops = [UpdateOne({'_id': m['_id']}, {'$setOnInsert': dict(
+            m, status='pending', attempts=0, nextAttemptAt=now, createdAt=now)}, upsert=True)
+            for m in messages]
+        if not ops:
+            return 0
+        return self.collection.bulk_write(ops, ordered=False).upserted_count
+
+    def _claim(self, limit):
+        '''
+        Claim up to about limit due messages for this delivery pass and return them as provider
+        batches. A message keeps the batchKey of the batch it was first sent in, so a retry
+        resends the same group under the same idempotency key.
+        '''
+        now = datetime.utcnow()
+        due = {'$or': [{'status': 'pending', 'nextAttemptAt': {'$lte': now}},
+                       {'status': 'sending', 'claimExpiresAt': {'$lt': now}}]}
+        docs = list(self.collection.find(due, {'_id': 1, 'batchKey': 1}).sort('nextAttemptAt', ASCENDING).limit(limit))
+        if not docs:
+            return []
+        ids = [doc['_id'] for doc in docs]
+        keys = list({doc['batchKey'] for doc in docs if doc.get('batchKey')})
+        if keys:
+            # Claim whole batches, even where the limit cut one in two
+            ids += [doc['_id'] for doc in self.collection.find(
+                {'$and': [due, {'batchKey': {'$in': keys}}, {'_id': {'$nin': ids}}]}, {'_id': 1})]
+        claim_id = uuid.uuid4().hex
+        # The due filter is checked again, so a message claimed meanwhile by another worker is skipped
+        self.collection.update_many(
+            {'$and': [{'_id': {'$in': ids}}, due]},
+            {'$set': {'status': 'sending', 'claimId': claim_id,
+                      'claimExpiresAt': now + timedelta(seconds=EMAIL_CLAIM_SECONDS)}})
+        messages = list(self.collection.find({'claimId': claim_id, 'status': 'sending'}))
+        batches = {}
+        new = [m for m in messages if not m.get('batchKey')]
+        for message in messages:
+            if message.get('batchKey'):
+                batches.setdefault(message['batchKey'], []).append(message)
+        size = self.provider.batch_size
+        for k in range(0, len(new), size):
+            key = uuid.uuid4().hex
+            batch = batches[key] = new[k:k + size]
+            self.collection.update_many({'_id': {'$in': [m['_id'] for m in batch]}}, {'$set': {'batchKey': key}})
+            for message in batch:
+                message['batchKey'] = key
+        return list(batches.values())
+
+    def _record(self, batch, provider_ids, error, rejected=False):
+        '''
+        Store the outcome of one provider call. Failed messages of a batch share one retry time
+        so they are claimed again together; rejected messages are not retried.
+        '''
+        now = datetime.utcnow()
+        jitter = random.uniform(0.8, 1.2)
+        ops = []
+        for k, message in enumerate(batch):
+            if error is None:
+                update = {'$set': {'status': 'sent', 'sentAt': now,
+                                   'providerId': provider_ids[k] if k < len(provider_ids) else None},
+                          '$unset': {'claimId': '', 'claimExpiresAt': ''}}
+                self.stats['sent'] += 1
+                EMAILS.inc(result='sent')
+            else:
+                attempts = message.get('attempts', 0) + 1
+                if rejected or attempts >= self.max_attempts:
+                    status, next_attempt = 'failed', None
+                    self.stats['failed'] += 1
+                    EMAILS.inc(result='failed')
+                else:
+                    backoff = EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1) * jitter
+                    status, next_attempt = 'pending', now + timedelta(seconds=backoff)
+                    self.stats['retried'] += 1
+                    EMAILS.inc(result='retried')
+                update = {'$set': {'status': status, 'attempts': attempts, 'nextAttemptAt': next_attempt,
+                                   'lastError': error},
+                          '$unset': {'claimId': '', 'claimExpiresAt': ''}}
+            update['$set']['batchKey'] = message['batchKey']
+            ops.append(UpdateOne({'_id': message['_id']}, update))
+        self.collection.bulk_write(ops, ordered=False)
+
+    async def _call(self, batch, limiter):
+        '''
+        One provider call for batch under its batchKey; returns (provider ids, error)
+        '''
+        await limiter.wait()
+        self.stats['provider_calls'] += 1
+        try:
+            with EMAIL_SEND_SECONDS.time(provider=getattr(self.provider, 'name', 'custom'), call='batch'):
+                provider_ids = await asyncio.to_thread(self.provider.send_batch, [
+                    {'to': m['to'], 'subject': m['subject'], 'html': m['html']} for m in batch], batch[0]['batchKey'])
+            return provider_ids, None
+        except Exception as e:
+            logging.warning(f"Sending {len(batch)} emails failed: {e}")
+            return [], e
+
+    def _rejected(self, error):
+        is_rejection = getattr(self.provider, 'is_rejection', None)
+        return error is not None and is_rejection is not None and is_rejection(error)
+
+    async def _send(self, batch, limiter, semaphore):
+        async with semaphore:
+            provider_ids, error = await self._call(batch, limiter)
+            rejected = self._rejected(error)
+            if not rejected or len(batch) == 1:
+                await asyncio.to_thread(self._record, batch, provider_ids, error and str(error), rejected)
+                return
+            # The provider refused the whole batch, typically for one invalid address: send
+            # each message on its own, under its own key from now on, so only the bad one fails
+            for message in batch:
+                message['batchKey'] = hashlib.sha256(f"single\0{message['_id']}".encode()).hexdigest()
+                provider_ids, error = await self._call([message], limiter)
+                await asyncio.to_thread(self._record, [message], provider_ids, error and str(error),
+                                        self._rejected(error))
+
+    async def deliver_due(self, max_messages=10000):
+        '''
+        Send every message that is due now, in provider batches, concurrently and rate-limited.
+        Failed sends are rescheduled with exponential backoff. Returns the number of messages claimed.
+        '''
+        batches = await asyncio.to_thread(self._claim, max_messages)
+        if not batches:
+            return 0
+        limiter = _RateLimiter(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self._send(batch, limiter, semaphore) for batch in batches])
+        return sum(len(batch) for batch in batches)
+
+    def next_attempt_in(self):
+        '''
+        Seconds until the next pending message is due, or None when nothing is pending
+        '''
+        doc = self.collection.find_one({'status': 'pending'}, {'nextAttemptAt': 1}, sort=[('nextAttemptAt', ASCENDING)])
+        if doc is None:
+            return None
+        return max(0.0, (doc['nextAttemptAt'] - datetime.utcnow()).total_seconds())
+
+
+_outbox = None
+
+
+def get_email_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = EmailOutbox()
+    return _outbox
+
+
+def main(watch=False, poll_seconds=30):
+    ensure_indexes()
+    outbox = get_email_outbox()
+    while True:
+        claimed = asyncio.run(outbox.deliver_due())
+        wait = outbox.next_attempt_in()
+        if not watch and (claimed == 0 or wait is None or wait > 0):
+            break
+        if claimed == 0:
+            time.sleep(min(poll_seconds, wait) if wait is not None else poll_seconds)
+    logging.info(f"Email outbox: {outbox.stats}")
+    close_client()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true", help="keep running and send retries as they come due")
+    args = parser.parse_args()
+    main(watch=args.watch)
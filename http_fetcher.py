@@ -0,0 +1,200 @@
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta
+import httpx
+from pymongo import UpdateOne
+from crawl_scheduler import normalize_url
+from utils import metrics
+import dotenv
+
+dotenv.load_dotenv()
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_FETCH_TIMEOUT", "15"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "32"))
+# Pages whose visible text is shorter than this are assumed to be rendered client-side
+MIN_STATIC_TEXT_CHARS = int(os.getenv("MIN_STATIC_TEXT_CHARS", "200"))
+# Re-probe pages flagged as needing a browser after this many days, in case they went static
+NEEDS_BROWSER_TTL_DAYS = int(os.getenv("NEEDS_BROWSER_TTL_DAYS", "7"))
+# Render pages known to be static without JavaScript when plain HTTP fails for them. Off by
+# default: a page that suddenly errors may be a bot challenge that needs JavaScript to pass.
+STATIC_RENDER_NO_JS = os.getenv("STATIC_RENDER_NO_JS", "false").lower() == "true"
+FETCH_SECONDS = metrics.histogram('fetch_seconds', 'Page fetch time by the tier that served it', ['tier'])
+FETCH_ESCALATIONS = metrics.counter('fetch_escalations', 'Pages sent to the browser tier, by reason', ['reason'])
+FETCH_FAILURES = metrics.counter('fetch_failures', 'Pages no tier could fetch')
+
+USER_AGENT = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/126.0 Safari/537.36")
+
+# Empty mount points of common SPA frameworks
+SPA_SHELL_PATTERNS = [
+    re.compile(r'<div[^>]+id=["\'](root|app|__next|__nuxt|___gatsby)["\'][^>]*>\s*</div>', re.I),
+    re.compile(r'<app-root[^>]*>\s*</app-root>', re.I),
+    re.compile(r'<noscript>[^<]*(enable|requires?) javascript', re.I),
+]
+_NON_TEXT = re.compile(r'<(script|style|noscript|template|svg)[^>]*>[\s\S]*?</\1>', re.I)
+_TAGS = re.compile(r'<[^>]+>')
+
+
+def looks_js_rendered(html):
+    '''
+    Cheap check for pages that need a browser: known SPA shells or almost no visible text
+    '''
+    if not html or not html.strip():
+        return True
+    if any(p.search(html) for p in SPA_SHELL_PATTERNS):
+        return True
+    text = _TAGS.sub(' ', _NON_TEXT.sub(' ', html))
+    return len(re.sub(r'\s+', '', text)) < MIN_STATIC_TEXT_CHARS
+
+
+class TieredFetcher:
+    '''
+    Fetches pages with a pooled HTTP client first and escalates to browser_fetch (an async
+    callable url, profile=None -> html) only when the response looks JS-rendered, is not HTML, fails, or
+    the URL was flagged as needing a browser on a previous run. ETag/Last-Modified are sent
+    back as conditional headers when the body they describe is in the previous snapshot, so an
+    unchanged static page returns 304 and fetch_html returns that snapshot page reference
+    ({'fingerprint', 'body'}) instead of HTML. Per-URL state (validators and snapshot body key,
+    never the page itself) lives in an optional MongoDB collection loaded/saved around a run.
+    '''
+
+    def __init__(self, browser_fetch, collection=None):
+        self.browser_fetch = browser_fetch
+        self.collection = collection
+        self._client = None
+        self._state = {}
+        self._dirty = set()
+        # Snapshot bodies a 304 may point at: those of the previous snapshots of this crawl
+        self._bodies = set()
+        self.stats = {'http': 0, 'not_modified': 0, 'browser': 0}
+
+    def load_state(self, urls, previous_pages=()):
+        '''
+        Load the state of urls; previous_pages are the pages of the snapshots this crawl
+        follows, whose bodies unchanged pages are answered with
+        '''
+        self._bodies.update(page['body'] for page in previous_pages if 'body' in page)
+        if self.collection is None:
+            return
+        keys = list({normalize_url(u) for u in urls if u})
+        # Page bodies stored inline by earlier versions are left out
+        for doc in self.collection.find({'_id': {'$in': keys}}, {'content': 0}):
+            self._state[doc['_id']] = doc
+
+    def remember_pages(self, pages):
+        '''
+        Record the snapshot body of each page ({'url', 'fingerprint', 'body'}) fetched over
+        plain HTTP, so the next crawl can answer a 304 with it
+        '''
+        for page in pages:
+            key = normalize_url(page['url'])
+            state = self._state.get(key)
+            if state is not None and state.get('awaiting_body') and 'body' in page:
+                state.pop('awaiting_body')
+                self._update(key, body=page['body'], fingerprint=page.get('fingerprint'))
+
+    def save_state(self):
+        if self.collection is None or not self._dirty:
+            return
+        ops = [UpdateOne({'_id': key}, {'$set': {k: v for k, v in self._state[key].items()
+                                                 if k not in ('_id', 'awaiting_body')},
+                                        '$unset': {'content': ''}},
+                         upsert=True) for key in self._dirty]
+        self.collection.bulk_write(ops, ordered=False)
+        self._dirty.clear()
+
+    def _update(self, key, **fields):
+        self._state.setdefault(key, {'_id': key}).update(fields, updated=datetime.utcnow())
+        self._dirty.add(key)
+
+    def _client_for_loop(self):
+        # Created lazily so the connection pool binds to the loop the crawl runs on
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=HTTP_TIMEOUT,
+                headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'},
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            )
+        return self._client
+
+    def _needs_browser(self, state):
+        # flaggedAt is when plain HTTP last fell short, not when the page was last rendered,
+        # so pages crawled more often than the TTL are still re-probed. States without it
+        # predate the field and are probed once.
+        if not state.get('needs_browser'):
+            return False
+        flagged = state.get('flaggedAt')
+        return flagged is not None and datetime.utcnow() - flagged < timedelta(days=NEEDS_BROWSER_TTL_DAYS)
+
+    async def _fetch_http(self, url, key, state):
+        '''
+        Return (page body, None), or (None, reason) if the page has to be rendered in a browser
+        '''
+        headers = {}
+        cached = state.get('body') in self._bodies
+        if cached:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        start = time.perf_counter()
+        response = await self._client_for_loop().get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            self.stats['not_modified'] += 1
+            FETCH_SECONDS.observe(time.perf_counter() - start, tier='not_modified')
+            return {'fingerprint': state.get('fingerprint'), 'body': state['body']}, None
+        if response.status_code >= 400:
+            return None, 'http_status'
+        if 'html' not in response.headers.get('content-type', 'text/html'):
+            return None, 'not_html'
+        html = response.text
+        if looks_js_rendered(html):
+            return None, 'js_rendered'
+        self.stats['http'] += 1
+        FETCH_SECONDS.observe(time.perf_counter() - start, tier='http')
+        # The body key is filled in by remember_pages once the page is in the snapshot store
+        self._update(key, needs_browser=False, body=None, fingerprint=None, etag=response.headers.get('etag'),
+                     last_modified=response.headers.get('last-modified'), awaiting_body=True)
+        return html, None
+
+    async def fetch_html(self, url):
+        key = normalize_url(url)
+        state = self._state.get(key, {})
+        if self._needs_browser(state):
+            reason = 'flagged'
+        else:
+            try:
+                html, reason = await self._fetch_http(url, key, state)
+                if html is not None:
+                    return html
+            except httpx.HTTPError as e:
+                reason = 'http_error'
+                logging.info(f"HTTP fetch failed for {url}, falling back to browser: {e}")
+        FETCH_ESCALATIONS.inc(reason=reason)
+        self.stats['browser'] += 1
+        # A page last seen as static HTML only failed over plain HTTP, so it needs no JavaScript
+        static = (STATIC_RENDER_NO_JS and state.get('needs_browser') is False
+                  and reason in ('http_error', 'http_status'))
+        with FETCH_SECONDS.time(tier='browser'):
+            html = await (self.browser_fetch(url, profile='static') if static else self.browser_fetch(url))
+        if html:
+            # Rendered pages carry no usable validators, so drop any stored ones. A page the
+            # static profile served still needs no JavaScript: keep probing it over HTTP.
+            fields = {'needs_browser': not static, 'body': None, 'fingerprint': None, 'etag': None,
+                      'last_modified': None, 'awaiting_body': False}
+            if reason != 'flagged' and not static:
+                # Plain HTTP was tried and fell short: (re)start the TTL before the next probe
+                fields['flaggedAt'] = datetime.utcnow()
+            self._update(key, **fields)
+        else:
+            FETCH_FAILURES.inc()
+        return html
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
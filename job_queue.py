@@ -0,0 +1,194 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+import dotenv
+
+dotenv.load_dotenv()
+
+# A claimed job is given back to the queue when its worker misses heartbeats for this long
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+# Jobs that failed or lost their lease this many times are marked failed instead of re-queued
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+
+class JobLease:
+    '''
+    Jobs a worker holds inside JobQueue.keep_alive. Release jobs together with their status
+    change (complete or fail) so heartbeats stop counting them; lost is set when a heartbeat
+    finds a held job leased to another worker.
+    '''
+
+    def __init__(self, jobs, heartbeat):
+        self._held = {job['_id']: job for job in jobs}
+        self._heartbeat = heartbeat
+        # Held across a heartbeat and across a status change plus release, so a heartbeat
+        # never counts a job completed meanwhile as lost
+        self._lock = threading.RLock()
+        self.lost = threading.Event()
+
+    def beat(self):
+        '''
+        Heartbeat every job still held
+        '''
+        with self._lock:
+            held = list(self._held.values())
+            if held and self._heartbeat(held) < len(held):
+                self.lost.set()
+
+    def still_held(self, jobs):
+        '''
+        Heartbeat jobs now; False once any lease of the batch was lost
+        '''
+        with self._lock:
+            if not self.lost.is_set() and self._heartbeat(jobs) < len(jobs):
+                self.lost.set()
+        return not self.lost.is_set()
+
+    def held(self):
+        with self._lock:
+            return list(self._held.values())
+
+    def release(self, jobs, update=None):
+        '''
+        Run update (the status change of jobs, e.g. JobQueue.complete) and stop heartbeating
+        jobs, with no heartbeat in between
+        '''
+        with self._lock:
+            if update is not None:
+                update()
+            for job in jobs:
+                self._held.pop(job['_id'], None)
+
+
+class JobQueue:
+    '''
+    Jobs in a MongoDB collection, claimed by any number of worker processes with atomic,
+    time-limited leases. Workers extend their leases with heartbeats; a job whose lease
+    expired (crashed or stuck worker) can be claimed again until JOB_MAX_ATTEMPTS is reached.
+
+    Job documents: {_id, runId, status: queued|running|done|failed, attempts, workerId,
+    leaseExpiresAt, lastError, createdAt, updatedAt} plus the fields given to enqueue.
+    '''
+
+    def __init__(self, collection, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.collection = collection
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+
+    def ensure_indexes(self):
+        self.collection.create_index([('status', ASCENDING), ('leaseExpiresAt', ASCENDING)])
+        self.collection.create_index([('runId', ASCENDING)])
+
+    def enqueue(self, run_id, jobs):
+        '''
+        Add jobs ({'_id', ...fields}) to run_id. Jobs that already exist are left as they are,
+        so planning the same run twice does not queue work twice.
+        '''
+        now = datetime.utcnow()
+        ops = [UpdateOne({'_id': job['_id']}, {'$setOnInsert': dict(
+            job, runId=run_id, status='queued', attempts=0, createdAt=now, updatedAt=now)}, upsert=True)
+            for job in jobs]
+        if not ops:
+            return 0
+        return self.collection.bulk_write(ops, ordered=False).upserted_count
+
+    def claim(self, worker_id, limit=1):
+        '''
+        Atomically lease up to limit queued (or lease-expired) jobs to worker_id
+        '''
+        now = datetime.utcnow()
+        # Expired leases that used up their attempts are not retried again
+        self.collection.update_many(
+            {'status': 'running', 'leaseExpiresAt': {'$lt': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'status': 'failed', 'lastError': 'lease expired', 'updatedAt': now}})
+        claimable = {'$or': [{'status': 'queued'},
+                             {'status': 'running', 'leaseExpiresAt': {'$lt': now}}]}
+        jobs = []
+        while len(jobs) < limit:
+            job = self.collection.find_one_and_update(
+                claimable,
+                {'$set': {'status': 'running', 'workerId': worker_id, 'leaseExpiresAt': now + self.lease,
+                          'updatedAt': now},
+                 '$inc': {'attempts': 1}},
+                sort=[('createdAt', ASCENDING)],
+                return_document=ReturnDocument.AFTER)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
+
+    def heartbeat(self, jobs, worker_id):
+        '''
+        Extend the leases of jobs still held by worker_id; returns how many were extended
+        '''
+        now = datetime.utcnow()
+        result = self.collection.update_many(
+            {'_id': {'$in': [job['_id'] for job in jobs]}, 'workerId': worker_id, 'status': 'running'},
+            {'$set': {'leaseExpiresAt': now + self.lease, 'updatedAt': now}})
+        if result.matched_count < len(jobs):
+            logging.warning(f"Worker {worker_id} lost {len(jobs) - result.matched_count} job leases")
+        return result.matched_count
+
+    @contextmanager
+    def keep_alive(self, jobs, worker_id):
+        '''
+        Heartbeat jobs from a background thread while the block runs. Yields a JobLease whose
+        lost event is set once another worker took over any of the jobs still held.
+        '''
+        lease = JobLease(jobs, lambda held: self.heartbeat(held, worker_id))
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease.total_seconds() / 3):
+                try:
+                    lease.beat()
+                except Exception as e:
+                    logging.warning(f"Heartbeat failed: {e}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield lease
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, jobs, worker_id):
+        self.collection.update_many(
+            {'_id': {'$in': [job['_id'] for job in jobs]}, 'workerId': worker_id},
+            {'$set': {'status': 'done', 'updatedAt': datetime.utcnow()}, '$unset': {'leaseExpiresAt': ''}})
+
+    def fail(self, jobs, worker_id, error):
+        '''
+        Give jobs back to the queue, or mark them failed once they used up their attempts
+        '''
+        now = datetime.utcnow()
+        for job in jobs:
+            status = 'failed' if job.get('attempts', 0) >= self.max_attempts else 'queued'
+            self.collection.update_one(
+                {'_id': job['_id'], 'workerId': worker_id},
+                {'$set': {'status': status, 'lastError': error, 'updatedAt': now},
+                 '$unset': {'leaseExpiresAt': ''}})
+
+    def retry_failed(self, run_id):
+        '''
+        Queue the failed jobs of run_id again with a fresh attempt budget
+        '''
+        result = self.collection.update_many(
+            {'runId': run_id, 'status': 'failed'},
+            {'$set': {'status': 'queued', 'attempts': 0, 'updatedAt': datetime.utcnow()}})
+        return result.modified_count
+
+    def active_leases(self):
+        return self.collection.count_documents(
+            {'status': 'running', 'leaseExpiresAt': {'$gte': datetime.utcnow()}})
+
+    def run_status(self, run_id):
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for row in self.collection.aggregate([{'$match': {'runId': run_id}},
+                                              {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[row['_id']] = row['count']
+        return counts
@@ -0,0 +1,159 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from utils.mongo import get_db
+import dotenv
+
+dotenv.load_dotenv()
+
+SCAN_CACHE_COLLECTION = "scan_cache"
+SCAN_CACHE_TTL_DAYS = float(os.getenv("SCAN_CACHE_TTL_DAYS", "7"))
+# Links scoring at least this are taken without asking the LLM
+LINK_CONFIDENCE = float(os.getenv("LINK_CONFIDENCE", "0.8"))
+
+LINK_FIELDS = ['pricing', 'blog', 'releaseNotes', 'playstore', 'appstore', 'linkedin', 'twitter']
+
+# First path segments that are not a profile on social sites
+TWITTER_RESERVED = {'intent', 'share', 'home', 'search', 'i', 'hashtag', 'login', 'signup', 'explore'}
+
+# Fields that can only point to these hosts: without any link there, they are known to be absent
+FIELD_HOSTS = {
+    'playstore': r'^play\.google\.com$',
+    'appstore': r'^(apps|itunes)\.apple\.com$',
+    'linkedin': r'(^|\.)linkedin\.com$',
+    'twitter': r'^(mobile\.)?(twitter|x)\.com$',
+}
+
+# (field, same site only, host pattern, path pattern, score)
+RULES = [
+    ('playstore', False, r'^play\.google\.com$', r'^/store/apps/details', 1.0),
+    ('playstore', False, r'^play\.google\.com$', r'^/store/apps/dev', 0.9),
+    ('appstore', False, r'^(apps|itunes)\.apple\.com$', r'^(/[a-z]{2})?/app/', 1.0),
+    ('appstore', False, r'^(apps|itunes)\.apple\.com$', r'^(/[a-z]{2})?/developer/', 0.9),
+    ('linkedin', False, r'(^|\.)linkedin\.com$', r'^/(company|school|showcase)/[^/]+/?$', 1.0),
+    ('linkedin', False, r'(^|\.)linkedin\.com$', r'^/(company|school|showcase)/', 0.85),
+    ('pricing', True, r'', r'^/(pricing|plans|prices|price)/?$', 1.0),
+    ('pricing', True, r'', r'(^|/)(pricing|plans)(/|$)', 0.85),
+    ('blog', True, r'^blog\.', r'^/?$', 1.0),
+    ('blog', True, r'', r'^/(blog|news|articles|insights|stories)/?$', 1.0),
+    ('blog', True, r'^blog\.', r'', 0.6),
+    ('releaseNotes', True, r'^(changelog|releases?|updates)\.', r'^/?$', 1.0),
+    ('releaseNotes', True, r'', r'^/(changelog|release-notes|releasenotes|releases|whats-new|what-s-new|product-updates)/?$', 1.0),
+    ('releaseNotes', True, r'', r'(^|/)(changelog|release-notes|releasenotes|whats-new|product-updates)(/|$)', 0.85),
+]
+
+
+def _host(url):
+    return (urlsplit(url).hostname or '').lower().removeprefix('www.')
+
+
+def site_domain(url):
+    '''
+    Domain a homepage is cached under: the host without www.
+    '''
+    return _host(url)
+
+
+def _same_site(host, site):
+    # Subdomains of the homepage host count as the same site (blog.example.com for
+    # example.com). Parent domains do not: for example.co.uk that would be all of co.uk.
+    return host == site or host.endswith('.' + site)
+
+
+def score_link(url, site):
+    '''
+    Best (field, score) for a link, or None when no rule matches
+    '''
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        return None
+    host = _host(url)
+    path = parts.path.lower()
+    if re.search(FIELD_HOSTS['twitter'], host):
+        segments = [s for s in path.split('/') if s]
+        if len(segments) == 1 and segments[0] not in TWITTER_RESERVED:
+            return 'twitter', 1.0
+        return None
+    best = None
+    for field, same_site, host_pattern, path_pattern, score in RULES:
+        if same_site and not _same_site(host, site):
+            continue
+        if host_pattern and not re.search(host_pattern, host):
+            continue
+        if path_pattern and not re.search(path_pattern, path):
+            continue
+        if best is None or score > best[1]:
+            best = (field, score)
+    return best
+
+
+def classify_links(homepage, links):
+    '''
+    Pick a URL per field from host and path patterns. Returns (fields, unresolved): fields
+    holds the confident picks (None for fields with no link on their only possible host),
+    unresolved the fields left for the LLM.
+    '''
+    site = site_domain(homepage)
+    hosts = {_host(link) for link in links}
+    candidates = {}
+    for link in links:
+        scored = score_link(link, site)
+        if scored is None:
+            continue
+        field, score = scored
+        # Higher score first, then the shortest URL (the index page rather than one post)
+        rank = (score, -len(link))
+        if field not in candidates or rank > candidates[field][0]:
+            candidates[field] = (rank, link)
+    fields = {field: link for field, ((score, _), link) in candidates.items() if score >= LINK_CONFIDENCE}
+    for field, host_pattern in FIELD_HOSTS.items():
+        if field not in fields and not any(re.search(host_pattern, host) for host in hosts):
+            fields[field] = None
+    unresolved = [field for field in LINK_FIELDS if field not in fields]
+    return fields, unresolved
+
+
+class ScanCache:
+    '''
+    Scan results per site domain in a MongoDB collection with a TTL index. Store errors
+    are logged and treated as misses so the cache never fails a scan.
+    '''
+
+    def __init__(self, collection=None, ttl=timedelta(days=SCAN_CACHE_TTL_DAYS)):
+        self._collection = collection
+        self._indexed = False
+        self._lock = threading.Lock()
+        self.ttl = ttl
+
+    def _store(self):
+        with self._lock:
+            if self._collection is None:
+                self._collection = get_db()[SCAN_CACHE_COLLECTION]
+            if not self._indexed:
+                self._collection.create_index('expiresAt', expireAfterSeconds=0)
+                self._indexed = True
+        return self._collection
+
+    def get(self, homepage):
+        try:
+            doc = self._store().find_one({'_id': site_domain(homepage), 'expiresAt': {'$gt': datetime.utcnow()}})
+        except Exception as e:
+            logging.warning(f"Scan cache lookup failed: {e}")
+            return None
+        return doc['fields'] if doc else None
+
+    def set(self, homepage, fields):
+        now = datetime.utcnow()
+        try:
+            self._store().update_one(
+                {'_id': site_domain(homepage)},
+                {'$set': {'fields': fields, 'homepage': homepage, 'createdAt': now, 'expiresAt': now + self.ttl}},
+                upsert=True)
+        except Exception as e:
+            logging.warning(f"Scan cache write failed: {e}")
+
+
+scan_cache = ScanCache()
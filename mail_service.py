@@ -2,20 +2,94 @@ import smtplib
 from email.mime.text import MIMEText
 import dotenv
 import os
+import threading
 import time
 import resend
+from utils import metrics
 
 dotenv.load_dotenv()
 GMAIL_PASSWORD = os.getenv("GMAIL_PASSWORD")
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 
+EMAIL_FROM = os.getenv("EMAIL_FROM", "onboarding@resend.dev")
+# "resend" or "stub" (records emails in memory, for local runs and tests)
+EMAIL_PROVIDER = os.getenv("EMAIL_PROVIDER", "resend")
+
+EMAIL_SEND_SECONDS = metrics.histogram('email_send_seconds', 'Mail provider call time', ['provider', 'call'])
+
+@metrics.timed(EMAIL_SEND_SECONDS, provider="resend", call="single")
 def send_email(receiver_email, subject, body):
     r = resend.Emails.send({
-    "from": "onboarding@resend.dev",
+    "from": EMAIL_FROM,
     "to": receiver_email,
     "subject": subject,
     "html": body
     })
+    return r
+
+class ResendProvider:
+    '''
+    Sends messages ({'to', 'subject', 'html'}) through Resend's batch API
+    '''
+    name = "resend"
+    # Resend accepts up to 100 emails per batch call
+    batch_size = 100
+
+    def send_batch(self, messages, idempotency_key=None):
+        '''
+        Send messages in one call and return their provider ids, in order
+        '''
+        params = [{"from": EMAIL_FROM, "to": m["to"], "subject": m["subject"], "html": m["html"]} for m in messages]
+        options = {"idempotency_key": idempotency_key} if idempotency_key else None
+        response = resend.Batch.send(params, options)
+        return [item.get("id") for item in response.get("data", [])]
+
+    def is_rejection(self, error):
+        '''
+        Whether the call was refused for its content (e.g. one invalid address), which fails
+        every message in the batch and will not succeed on a retry
+        '''
+        return isinstance(error, resend.exceptions.ResendError) and str(error.code) in ("400", "422")
+
+class StubProvider:
+    '''
+    Offline provider: keeps sent messages in memory, optionally with a delay per call,
+    failing the first fail_first calls and rejecting every batch addressed to one of reject_to
+    '''
+    name = "stub"
+
+    def __init__(self, batch_size=100, delay=0.0, fail_first=0, reject_to=()):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.fail_first = fail_first
+        self.reject_to = set(reject_to)
+        self.calls = 0
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages, idempotency_key=None):
+        with self._lock:
+            self.calls += 1
+            fail = self.calls <= self.fail_first
+        if self.delay:
+            time.sleep(self.delay)
+        if fail:
+            raise RuntimeError("stub provider failure")
+        rejected = [m["to"] for m in messages if m["to"] in self.reject_to]
+        if rejected:
+            raise ValueError(f"stub provider rejected {rejected[0]}")
+        with self._lock:
+            ids = [f"stub-{len(self.sent) + k}" for k in range(len(messages))]
+            self.sent.extend(messages)
+        return ids
+
+    def is_rejection(self, error):
+        return isinstance(error, ValueError)
+
+def get_email_provider(name=EMAIL_PROVIDER):
+    if name == "stub":
+        return StubProvider()
+    return ResendProvider()
 
 # def send_email(receiver_email, subject, body, retries=3, delay=2):
 #     sender_email = "competitoriq@gmail.com"
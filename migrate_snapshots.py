@@ -0,0 +1,63 @@
+'''
+One-off migration for snapshots written before page bodies moved to the snapshot store:
+parses the raw HTML of legacy pages once, writes each page body (paragraph list, plus the
+HTML with --keep-html) to the compressed snapshot store and replaces the inline page with
+a reference. Pages that already hold paragraphs inline are moved as they are. Safe to
+re-run; migrated pages are skipped.
+
+    python migrate_snapshots.py [--keep-html] [--dry-run]
+'''
+import argparse
+import logging
+from utils.mongo import get_db, close_client
+from html_processing_library import snapshot_page
+from snapshot_store import get_snapshot_store
+import dotenv
+
+dotenv.load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+COLLECTION_NAME = "competitors"
+
+
+def migrate_snapshots(snapshots, keep_html, store=None):
+    '''
+    Return (snapshots, number of pages migrated). Without a store the pages are only
+    converted in memory (dry run).
+    '''
+    migrated = 0
+    previous = None
+    for snapshot in snapshots:
+        pages = []
+        for page in snapshot.get('pages', []):
+            if 'body' not in page:
+                if 'paragraphs' not in page:
+                    page = snapshot_page(page['url'], page.get('content', ''), keep_html=keep_html)
+                migrated += 1
+            pages.append(page)
+        snapshot['pages'] = store.put_pages(pages, previous=previous) if store is not None else pages
+        previous = snapshot['pages']
+    return snapshots, migrated
+
+
+def main(keep_html=False, dry_run=False):
+    collection = get_db()[COLLECTION_NAME]
+    store = None if dry_run else get_snapshot_store()
+    total_docs = total_pages = 0
+    legacy = {'snapshots.pages': {'$elemMatch': {'body': {'$exists': False}}}}
+    for competitor in collection.find(legacy, {'snapshots': 1}):
+        snapshots, migrated = migrate_snapshots(competitor.get('snapshots', []), keep_html, store)
+        if not dry_run:
+            collection.update_one({'_id': competitor['_id']}, {'$set': {'snapshots': snapshots}})
+        total_docs += 1
+        total_pages += migrated
+    logging.info(f"{'Would migrate' if dry_run else 'Migrated'} {total_pages} pages in {total_docs} competitors")
+    close_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keep-html", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    main(keep_html=args.keep_html, dry_run=args.dry_run)
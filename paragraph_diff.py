@@ -0,0 +1,189 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import difflib
+
+# Regions without unique common paragraphs fall back to difflib, which is quadratic, only when
+# len(a) * len(b) stays below this; larger regions are reported as a plain replacement
+FALLBACK_MAX_CELLS = 1_000_000
+
+
+def _hash_lines(a, b):
+    '''
+    Map paragraphs to small ints so comparisons and counting never touch the strings again
+    '''
+    ids = {}
+    return [ids.setdefault(p, len(ids)) for p in a], [ids.setdefault(p, len(ids)) for p in b]
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    '''
+    Longest increasing run of paragraphs that occur exactly once on both sides (patience diff)
+    '''
+    counts_a = Counter(a[alo:ahi])
+    counts_b = Counter(b[blo:bhi])
+    pos_b = {}
+    for j in range(blo, bhi):
+        if counts_b[b[j]] == 1:
+            pos_b[b[j]] = j
+    pairs = [(i, pos_b[a[i]]) for i in range(alo, ahi) if counts_a[a[i]] == 1 and a[i] in pos_b]
+    if not pairs:
+        return []
+    # Patience sorting over the b positions, in a order
+    tails, tail_idx, back = [], [], [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        back[k] = tail_idx[pile - 1] if pile else None
+        if pile == len(tails):
+            tails.append(j)
+            tail_idx.append(k)
+        else:
+            tails[pile] = j
+            tail_idx[pile] = k
+    anchors = []
+    k = tail_idx[-1]
+    while k is not None:
+        anchors.append(pairs[k])
+        k = back[k]
+    anchors.reverse()
+    return anchors
+
+
+def _matching_pairs(a, b):
+    '''
+    Sorted (i, j) pairs of matched paragraphs. Common prefix/suffix are trimmed, unique
+    paragraphs anchor the alignment and the gaps between anchors are processed the same way.
+    '''
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            prev_i, prev_j = alo, blo
+            for i, j in anchors:
+                matches.append((i, j))
+                stack.append((prev_i, i, prev_j, j))
+                prev_i, prev_j = i + 1, j + 1
+            stack.append((prev_i, ahi, prev_j, bhi))
+        elif (ahi - alo) * (bhi - blo) <= FALLBACK_MAX_CELLS:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            for i, j, size in matcher.get_matching_blocks():
+                matches.extend((alo + i + k, blo + j + k) for k in range(size))
+    matches.sort()
+    return matches
+
+
+def _edit_script(a, b):
+    '''
+    Line-by-line edits as (op, i, j) with op in ' ', '-', '+'; i and j are the positions
+    in a and b at that point of the script
+    '''
+    script = []
+    i = j = 0
+    for mi, mj in _matching_pairs(a, b) + [(len(a), len(b))]:
+        script.extend(('-', k, j) for k in range(i, mi))
+        script.extend(('+', mi, k) for k in range(j, mj))
+        if mi < len(a):
+            script.append((' ', mi, mj))
+        i, j = mi + 1, mj + 1
+    return script
+
+
+def _extract_moves(script, a, b):
+    '''
+    Pair deleted and inserted copies of the same paragraph as moves and drop them from script
+    '''
+    deleted = defaultdict(list)
+    inserted = defaultdict(list)
+    for k, (op, i, j) in enumerate(script):
+        if op == '-':
+            deleted[a[i]].append(k)
+        elif op == '+':
+            inserted[b[j]].append(k)
+    moved = []
+    hidden = set()
+    for line, del_keys in deleted.items():
+        for dk, ik in zip(del_keys, inserted.get(line, [])):
+            moved.append((script[dk][1], script[ik][2]))
+            hidden.update((dk, ik))
+    moved.sort()
+    return [edit for k, edit in enumerate(script) if k not in hidden], moved
+
+
+def _format_range(start, length):
+    # Same convention as difflib.unified_diff hunk headers
+    beginning = start + 1
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def _unified_lines(script, a, b, n):
+    changes = [k for k, (op, _, _) in enumerate(script) if op != ' ']
+    if not changes:
+        return []
+    lines = ['--- \n', '+++ \n']
+    # Group changes into one hunk unless more than 2n unchanged lines separate them, as
+    # difflib's get_grouped_opcodes does
+    hunks = []
+    start, end = changes[0], changes[0]
+    for k in changes[1:]:
+        if k - end - 1 > 2 * n:
+            hunks.append((start, end))
+            start = k
+        end = k
+    hunks.append((start, end))
+    for start, end in hunks:
+        hunk = script[max(0, start - n):min(len(script), end + n + 1)]
+        old_len = sum(1 for op, _, _ in hunk if op != '+')
+        new_len = sum(1 for op, _, _ in hunk if op != '-')
+        lines.append(f'@@ -{_format_range(hunk[0][1], old_len)} +{_format_range(hunk[0][2], new_len)} @@\n')
+        for op, i, j in hunk:
+            lines.append(op + (b[j] if op == '+' else a[i]))
+    return lines
+
+
+def diff_paragraph_lists(paragraphs1, paragraphs2, n=3, detect_moves=True):
+    '''
+    Diff two paragraph lists in near-linear time on typical pages (patience diff over
+    hashed paragraphs). Returns (lines, moved): lines in the format of difflib.unified_diff
+    with n lines of context, and moved as (old_index, new_index, paragraph) for paragraphs
+    that only changed position. Moved paragraphs are left out of lines when detect_moves is set.
+    '''
+    a, b = _hash_lines(paragraphs1, paragraphs2)
+    script = _edit_script(a, b)
+    moved = []
+    if detect_moves:
+        script, moves = _extract_moves(script, a, b)
+        moved = [(i, j, paragraphs1[i]) for i, j in moves]
+    return _unified_lines(script, paragraphs1, paragraphs2, n), moved
+
+
+def copy_runs(paragraphs1, paragraphs2):
+    '''
+    paragraphs2 rebuilt from paragraphs1: [start, count] copies paragraphs1[start:start + count]
+    and a string is a paragraph that is not in paragraphs1 at that point
+    '''
+    a, b = _hash_lines(paragraphs1, paragraphs2)
+    runs = []
+    for op, i, j in _edit_script(a, b):
+        if op == '+':
+            runs.append(paragraphs2[j])
+        elif op == ' ':
+            if runs and isinstance(runs[-1], list) and sum(runs[-1]) == i:
+                runs[-1][1] += 1
+            else:
+                runs.append([i, 1])
+    return runs
@@ -1,27 +1,56 @@
+import argparse
 import asyncio
-from datetime import datetime, date
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+from utils.mongo import get_db, ensure_indexes, close_client, get_round_trips
+from pymongo import UpdateOne
 from bson import ObjectId
-from playwright.async_api import async_playwright
+from crawl_scheduler import CrawlScheduler
+from http_fetcher import TieredFetcher
+from browser_pool import get_browser_pool, run_sync, shutdown as shutdown_browser_pool
 from bs4 import BeautifulSoup
-from AiLib import generate_response
-import difflib
+from AiLib import generate_response_async, get_cache_stats, get_async_client, estimate_tokens
+from token_budget import allocate_budget, chunk_diffs
 import logging
 import json
 import re
-from html_processing_library import diff_html  
-from mail_service import send_email
+from html_processing_library import snapshot_page
+from snapshot_store import get_snapshot_store, diff_snapshots, SNAPSHOT_RETENTION
+from email_outbox import get_email_outbox
 from utils.clerk_auth import get_user_mails
+from job_queue import JobQueue
+from pipeline_runs import PipelineRun, reached
+from utils import metrics
 import os
+import socket
+import time
 import dotenv
 
 dotenv.load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = "competitorIQ"
 COLLECTION_NAME = "competitors"
 USER_PREFS_COLLECTION = "user_preferences"
+FETCH_STATE_COLLECTION = "fetch_state"
+# Keep raw page HTML in snapshots next to the paragraph lists (only needed for debugging)
+SNAPSHOT_KEEP_HTML = os.getenv("SNAPSHOT_KEEP_HTML", "false").lower() == "true"
+# Max diff tokens sent to Gemini per competitor; larger diffs are truncated to fit
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "120000"))
+# Max diff tokens per summarization call; bigger budgets are split into parallel calls
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "30000"))
+# Max tokens of summary bullets passed to the email prompt per user
+EMAIL_SUMMARY_TOKEN_BUDGET = int(os.getenv("EMAIL_SUMMARY_TOKEN_BUDGET", "20000"))
+# Jobs of distributed runs (--plan / --worker)
+PIPELINE_JOBS_COLLECTION = "pipeline_jobs"
+# Users a worker claims and processes together; they share crawling and Gemini concurrency
+PIPELINE_WORKER_BATCH = int(os.getenv("PIPELINE_WORKER_BATCH", "10"))
+
+PIPELINE_STAGE_SECONDS = metrics.histogram('pipeline_stage_seconds', 'Time per pipeline stage and user batch', ['stage'])
+
+def _stage_done(stage, started):
+    # Record a stage that began at started and return the start of the next one
+    now = time.perf_counter()
+    PIPELINE_STAGE_SECONDS.observe(now - started, stage=stage)
+    return now
 
 def get_tracked_urls(competitor):
     urls = [competitor.get('homepage')]
@@ -34,41 +63,32 @@ def get_tracked_urls(competitor):
     urls.extend([u for u in custom if u])
     return list(set(urls))
 
-def diff_snapshots(snap1, snap2):
-    diff_by_url = {}
-    pages1 = {p['url']: p['content'] for p in snap1.get('pages', [])}
-    pages2 = {p['url']: p['content'] for p in snap2.get('pages', [])}
-    all_urls = set(pages1) | set(pages2)
-    for url in all_urls:
-        content1 = pages1.get(url, '')
-        content2 = pages2.get(url, '')
-        diff = diff_html(content1, content2)  
-        diff_by_url[url] = '\n'.join(diff)
-    # print(diff_by_url)
-    return diff_by_url
-
-# Fetch HTML using Playwright
-async def fetch_html(url):
+def build_pages(urls, crawled, parsed):
+    '''
+    Snapshot pages for urls from the run-wide crawl results. parsed caches
+    html -> snapshot page so a page shared by many competitors is parsed once.
+    '''
+    pages = []
+    for url in urls:
+        content = crawled.get(url, '')
+        if isinstance(content, dict):
+            # Not modified since the previous snapshot: reuse its page body
+            pages.append(dict(content, url=url))
+            continue
+        if content not in parsed:
+            parsed[content] = snapshot_page(url, content, keep_html=SNAPSHOT_KEEP_HTML)
+        pages.append(dict(parsed[content], url=url))
+    return pages
+
+# Fetch HTML using the shared Playwright browser pool (fallback tier of TieredFetcher)
+async def fetch_html(url, profile=None):
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-            await page.goto(url, timeout=20000)
-            html = await page.content()
-            await browser.close()
-            return html
+        return await get_browser_pool().fetch_html(url, profile=profile)
     except Exception as e:
         logging.warning(f"Failed to crawl {url}: {e}")
         return ""
 
-async def crawl_urls(urls):
-    pages = []
-    for url in urls:
-        html = await fetch_html(url)
-        pages.append({'url': url, 'content': html})
-    return pages
-
-def summarize_with_gemini(diff_by_url):
+def build_summary_prompt(diff_by_url):
     prompt = """
 You are an expert AI product analyst for CompetitorIQ, a tool that tracks changes in competitors' products.
 You will be given the HTML diffs for all tracked pages of a single competitor.
@@ -85,7 +105,9 @@ Diffs:
     for url, diff in diff_by_url.items():
         prompt += f"\nURL: {url}\nDiff:\n{diff}\n"
     prompt += "\nJSON:"
-    response = generate_response(prompt)
+    return prompt
+
+def parse_summary(response):
     try:
         match = re.search(r'\[[\s\S]*\]', response)
         if match:
@@ -96,10 +118,57 @@ Diffs:
         summary_list = ["No changes detected"]
     return summary_list
 
+def build_merge_prompt(partial_summaries):
+    return f"""
+You are an expert AI product analyst for CompetitorIQ, a tool that tracks changes in competitors' products.
+The following JSON lists each summarize the changes found in one part of a single competitor's tracked pages.
+Merge them into one prioritized list of bullet points (one change per bullet): remove duplicates and entries that say no changes were detected, and put the most impactful changes at the top.
+Return a JSON array of strings. If no meaningful changes remain, return ["No changes detected"].
+
+Partial summaries:
+{json.dumps(partial_summaries, indent=2)}
+
+JSON:"""
+
+async def summarize_with_gemini_async(diff_by_url, label=''):
+    '''
+    Map-reduce summarization: diffs are truncated to the per-competitor token budget, packed
+    into chunks that are summarized in parallel, and the partial lists merged in one more call
+    '''
+    budgeted = allocate_budget(diff_by_url, SUMMARY_TOKEN_BUDGET)
+    chunks = chunk_diffs(budgeted, SUMMARY_CHUNK_TOKENS)
+    usage = {}
+    partials = await asyncio.gather(*[
+        generate_response_async(build_summary_prompt(chunk), usage_out=usage) for chunk in chunks
+    ])
+    partials = [parse_summary(response) for response in partials]
+    changes = [summary for summary in partials if summary != ["No changes detected"]]
+    if len(changes) > 1:
+        summary_list = parse_summary(await generate_response_async(build_merge_prompt(changes), usage_out=usage))
+    else:
+        summary_list = changes[0] if changes else ["No changes detected"]
+    input_tokens = sum(estimate_tokens(d) for d in diff_by_url.values())
+    logging.info(f"Summarized {label}: ~{input_tokens} diff tokens, {len(chunks)} chunks, "
+                 f"{usage.get('prompt_tokens', 0)} prompt / {usage.get('output_tokens', 0)} output tokens used")
+    return summary_list
+
+def fit_summary_blocks(summary_blocks, budget=EMAIL_SUMMARY_TOKEN_BUDGET):
+    '''
+    Trim each competitor's bullet list (already ordered by impact) from the bottom, longest
+    list first, until all blocks fit the email prompt budget
+    '''
+    blocks = [dict(block, summary=list(block['summary'])) for block in summary_blocks]
+    while estimate_tokens(json.dumps(blocks)) > budget:
+        longest = max(blocks, key=lambda block: len(block['summary']))
+        if len(longest['summary']) <= 1:
+            break
+        longest['summary'].pop()
+    return blocks
 
-def generate_user_email_content(user_id, summary_blocks, total_pages, competitor_names):
+def build_email_prompt(summary_blocks, total_pages, competitor_names):
+    summary_blocks = fit_summary_blocks(summary_blocks)
     # Compose prompt for Gemini to generate subject and body
-    prompt = f"""
+    return f"""
 You are an expert product analyst and email copywriter for CompetitorIQ. Write a concise, actionable email update for the user summarizing all tracked competitors' changes.
 
 Details to include:
@@ -113,7 +182,8 @@ Summaries:
 
 Return a JSON object with two fields: 'subject' (string) and 'body' (string, can be HTML or plain text). Do not include any explanations or headers.
 """
-    response = generate_response(prompt)
+
+def parse_email(response):
     try:
         match = re.search(r'\{[\s\S]*\}', response)
         if match:
@@ -124,98 +194,396 @@ Return a JSON object with two fields: 'subject' (string) and 'body' (string, can
         mail_json = {"subject": "CompetitorIQ Update", "body": "No changes detected."}
     return mail_json
 
-def main():
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
-    user_prefs_collection = db[USER_PREFS_COLLECTION]
-    competitors = list(collection.find({}))
+async def generate_user_email_content_async(user_id, summary_blocks, total_pages, competitor_names):
+    prompt = build_email_prompt(summary_blocks, total_pages, competitor_names)
+    return parse_email(await generate_response_async(prompt))
+
+async def gather_all(coros):
+    # asyncio.gather must be called on the loop that runs it, so wrap it for run_sync
+    return await asyncio.gather(*coros)
+
+async def _gemini_stats():
+    return dict(get_async_client().stats)
+
+def load_user_competitors(collection, user_ids=None):
+    '''
+    Competitors grouped by user, each with only its two latest snapshots (the diff and delta
+    base of this run's one, and this run's one when a retried run already took it); summaries
+    and old snapshots are by far the largest fields
+    '''
+    query = {'userId': {'$in': list(user_ids)}} if user_ids is not None else {}
+    competitors = list(collection.find(query, {'userId': 1, 'name': 1, 'homepage': 1, 'fields': 1,
+                                               'snapshots': {'$slice': -2}}))
     logging.info(f"Found {len(competitors)} competitors.")
-    # Group competitors by user
     user_map = {}
     for competitor in competitors:
         user_id = competitor.get('userId')
         if not user_id:
             continue
         user_map.setdefault(user_id, []).append(competitor)
-    # Get all user emails once
-    user_mails = get_user_mails()
-    today = date.today()
-    weekday = today.weekday()  
-    day_of_month = today.day
+    return user_map
+
+def load_preferences(db, user_ids):
+    # Preferences of every user in one query
+    return {doc['userId']: doc.get('preferences', {}) for doc in db[USER_PREFS_COLLECTION].find(
+        {'userId': {'$in': list(user_ids)}}, {'userId': 1, 'preferences': 1})}
+
+def is_due(prefs, today):
+    '''
+    Whether a user with these preferences gets an update today
+    '''
+    update_freq = prefs.get('updateFreq', 'daily')
+    if update_freq == 'daily':
+        return True
+    if update_freq == 'weekly' and today.weekday() == 0:
+        return True
+    if update_freq == 'monthly' and today.day == 1:
+        return True
+    return False
+
+def schedule_users(db, user_map, today):
+    '''
+    (user_id, competitors, receive_email) for the users due today
+    '''
+    prefs_by_user = load_preferences(db, user_map)
+    scheduled_users = []
     for user_id, user_competitors in user_map.items():
-        # Fetch user preferences
-        prefs_doc = user_prefs_collection.find_one({'userId': user_id})
-        prefs = prefs_doc.get('preferences', {}) if prefs_doc else {}
-        update_freq = prefs.get('updateFreq', 'daily')
-        receive_email = prefs.get('receiveEmail', True)
-        # Determine if we should run for this user
-        should_run = False
-        if update_freq == 'daily':
-            should_run = True
-        elif update_freq == 'weekly' and weekday == 0:
-            should_run = True
-        elif update_freq == 'monthly' and day_of_month == 1:
-            should_run = True
-        if not should_run:
-            logging.info(f"Skipping user {user_id} due to updateFreq ({update_freq})")
+        prefs = prefs_by_user.get(user_id, {})
+        if not is_due(prefs, today):
+            logging.info(f"Skipping user {user_id} due to updateFreq ({prefs.get('updateFreq')})")
             continue
-        summary_blocks = []
-        total_pages = 0
-        competitor_names = [c.get('name') for c in user_competitors]
-
-        # For each competitor, update snapshots and summaries
-        for competitor in user_competitors:
-            urls = get_tracked_urls(competitor)
-            # Take new snapshot
-            pages = asyncio.run(crawl_urls(urls))
-            snapshot = {
-                'date': datetime.utcnow(),
-                'pages': pages
-            }
-            total_pages += len(pages)
-            # Add snapshot, keep only 2 most recent
-            collection.update_one(
-                {'_id': competitor['_id']},
-                {'$push': {'snapshots': {'$each': [snapshot], '$slice': -2}}}
-            )
-            # Refresh competitor with latest snapshots
-            updated_competitor = collection.find_one({'_id': competitor['_id']})
-            
-            # Generate and store summary
-            snaps = updated_competitor.get('snapshots', [])
-            summary_list = ["No changes detected"]
-            summary_date = datetime.utcnow()
-
-            if len(snaps) >= 2:
-                snap1, snap2 = snaps[-2], snaps[-1]
-                diff_by_url = diff_snapshots(snap1, snap2)
-                summary_list = summarize_with_gemini(diff_by_url)
-                summary_date = snap2['date']
-            
-            summary_doc = {'date': summary_date, 'summary': summary_list}
-            collection.update_one(
-                {'_id': competitor['_id']},
-                {'$push': {'summaries': {'$each': [summary_doc], '$slice': -10}}}
-            )
-
-            summary_blocks.append({
-                'competitor': competitor.get('name'),
-                'summary': summary_list
-            })
-
-        # Generate email content for this user
-        mail_json = generate_user_email_content(user_id, summary_blocks, total_pages, competitor_names)
+        scheduled_users.append((user_id, user_competitors, prefs.get('receiveEmail', True)))
+    return scheduled_users
+
+def run_users(db, scheduled_users, user_mails, run):
+    '''
+    Crawl, snapshot, diff, summarize and email for a batch of users. Crawling and Gemini
+    calls are shared across the whole batch. Each stage is checkpointed per competitor in
+    run, and stages an earlier attempt of the run finished are skipped.
+    '''
+    collection = db[COLLECTION_NAME]
+    scheduled = [competitor for _, user_competitors, _ in scheduled_users for competitor in user_competitors]
+    checkpoints = run.load([competitor['_id'] for competitor in scheduled])
+    # This run's snapshot when an earlier attempt already took it, and the one before it
+    snapshots, previous = {}, {}
+    for competitor in scheduled:
+        snaps = competitor.get('snapshots', [])
+        if snaps and snaps[-1].get('runId') == run.run_id:
+            snapshots[competitor['_id']] = snaps[-1]
+            snaps = snaps[:-1]
+        previous[competitor['_id']] = snaps[-1] if snaps else None
+    to_crawl = [competitor for competitor in scheduled if competitor['_id'] not in snapshots]
+    if len(to_crawl) < len(scheduled):
+        logging.info(f"Run {run.run_id}: {len(scheduled) - len(to_crawl)} competitors already crawled")
+
+    started = time.perf_counter()
+    # Crawl every tracked URL of the run up front, concurrently, on a single event loop
+    run_urls = [url for competitor in to_crawl for url in get_tracked_urls(competitor)]
+    previous_pages = [page for competitor in to_crawl if previous[competitor['_id']]
+                      for page in previous[competitor['_id']].get('pages', [])]
+    fetcher = TieredFetcher(fetch_html, db[FETCH_STATE_COLLECTION])
+    fetcher.load_state(run_urls, previous_pages)
+    scheduler = CrawlScheduler(fetcher.fetch_html)
+    try:
+        crawled = run_sync(scheduler.crawl(run_urls))
+    finally:
+        run_sync(fetcher.close())
+    logging.info(f"Fetch tiers: {fetcher.stats['http']} plain HTTP, {fetcher.stats['not_modified']} not modified, "
+                 f"{fetcher.stats['browser']} browser")
+    logging.info(f"Fetch dedup: {scheduler.stats['requested']} tracked URLs, {scheduler.stats['fetched']} fetched, "
+                 f"{scheduler.stats['saved']} fetches saved")
+    started = _stage_done('crawl', started)
+
+    parsed = {}
+    store = get_snapshot_store()
+    # Take the new snapshots from the run-wide crawl results. Page bodies of all competitors go
+    # to the snapshot store in one batch, delta-encoded against the previous snapshots' bodies;
+    # the competitor documents keep references
+    new_pages = [build_pages(get_tracked_urls(competitor), crawled, parsed) for competitor in to_crawl]
+    refs = store.put_pages([page for pages in new_pages for page in pages], previous=previous_pages)
+    # Fetch state points at the stored bodies, so the next run can answer a 304 with them
+    fetcher.remember_pages(refs)
+    fetcher.save_state()
+    refs = iter(refs)
+    new_snapshots = {}
+    for competitor, pages in zip(to_crawl, new_pages):
+        new_snapshots[competitor['_id']] = {
+            'date': datetime.utcnow(),
+            'runId': run.run_id,
+            'pages': [next(refs) for _ in pages]
+        }
+    # Add the snapshots, keeping the SNAPSHOT_RETENTION most recent. A snapshot is pushed at
+    # most once per run, so a retried run never shifts the history
+    if new_snapshots:
+        collection.bulk_write([
+            UpdateOne({'_id': competitor_id, 'snapshots.runId': {'$ne': run.run_id}},
+                      {'$push': {'snapshots': {'$each': [snapshot], '$slice': -SNAPSHOT_RETENTION}}})
+            for competitor_id, snapshot in new_snapshots.items()
+        ], ordered=False)
+        run.mark('crawled', {competitor_id: {'snapshotDate': snapshot['date']}
+                             for competitor_id, snapshot in new_snapshots.items()})
+    snapshots.update(new_snapshots)
+    started = _stage_done('snapshot', started)
+
+    # Diff each new snapshot against the previous one (already in memory). The checkpoint
+    # keeps the dates of the two snapshots and the number of changed pages, not the diff
+    # text, which could outgrow a document; a resumed run diffs the same two snapshots again
+    diffs, summary_dates, diffed = {}, {}, {}
+    for competitor in scheduled:
+        competitor_id = competitor['_id']
+        checkpoint = checkpoints.get(competitor_id)
+        if reached(checkpoint, 'diffed'):
+            if 'diff' in checkpoint:
+                # Checkpoints written before diffs were left out of them
+                diffs[competitor_id] = dict(checkpoint['diff'])
+            elif checkpoint.get('changed') and previous[competitor_id]:
+                diffs[competitor_id] = diff_snapshots(previous[competitor_id], snapshots[competitor_id])
+            else:
+                diffs[competitor_id] = {}
+            summary_dates[competitor_id] = checkpoint['summaryDate']
+            continue
+        diff_by_url = {}
+        summary_date = datetime.utcnow()
+        if previous[competitor_id]:
+            diff_by_url = diff_snapshots(previous[competitor_id], snapshots[competitor_id])
+            if not diff_by_url:
+                logging.info(f"No page of {competitor.get('name')} changed, skipping summarization")
+            summary_date = snapshots[competitor_id]['date']
+        diffs[competitor_id] = diff_by_url
+        summary_dates[competitor_id] = summary_date
+        diffed[competitor_id] = {
+            'compared': [previous[competitor_id]['date'] if previous[competitor_id] else None,
+                         snapshots[competitor_id]['date']],
+            'changed': len(diff_by_url), 'summaryDate': summary_date}
+    run.mark('diffed', diffed)
+    started = _stage_done('diff', started)
+
+    # Summarize every changed competitor of the run concurrently, spread over all Gemini keys
+    summary_lists = {competitor_id: checkpoint['summary'] for competitor_id, checkpoint in checkpoints.items()
+                     if reached(checkpoint, 'summarized')}
+    changed = [competitor for competitor in scheduled
+               if competitor['_id'] not in summary_lists and diffs[competitor['_id']]]
+    results = run_sync(gather_all([summarize_with_gemini_async(diffs[competitor['_id']], competitor.get('name'))
+                                   for competitor in changed]))
+    summary_lists.update(zip([competitor['_id'] for competitor in changed], results))
+    summarized = {}
+    for competitor in scheduled:
+        if competitor['_id'] not in summary_lists:
+            summary_lists[competitor['_id']] = ["No changes detected"]
+        if not reached(checkpoints.get(competitor['_id']), 'summarized'):
+            summarized[competitor['_id']] = {'summary': summary_lists[competitor['_id']]}
+    # Pushed at most once per run, like the snapshots
+    summary_writes = [UpdateOne(
+        {'_id': competitor_id, 'summaries.runId': {'$ne': run.run_id}},
+        {'$push': {'summaries': {'$each': [{'date': summary_dates[competitor_id], 'runId': run.run_id,
+                                            'summary': summary_lists[competitor_id]}], '$slice': -10}}}
+    ) for competitor_id in summarized]
+    if summary_writes:
+        collection.bulk_write(summary_writes, ordered=False)
+    run.mark('summarized', summarized)
+    started = _stage_done('summarize', started)
+
+    email_jobs = []
+    for user_id, user_competitors, receive_email in scheduled_users:
+        if all(reached(checkpoints.get(competitor['_id']), 'emailed') for competitor in user_competitors):
+            logging.info(f"User {user_id} was already emailed in run {run.run_id}")
+            continue
+        summary_blocks = [{
+            'competitor': competitor.get('name'),
+            'summary': summary_lists[competitor['_id']]
+        } for competitor in user_competitors]
+        total_pages = sum(len(snapshots[competitor['_id']]['pages']) for competitor in user_competitors)
+        competitor_names = [competitor.get('name') for competitor in user_competitors]
+        email_jobs.append((user_id, user_competitors, receive_email, summary_blocks, total_pages, competitor_names))
+
+    # Generate email content for every user concurrently
+    mails = run_sync(gather_all([
+        generate_user_email_content_async(user_id, summary_blocks, total_pages, competitor_names)
+        for user_id, _, _, summary_blocks, total_pages, competitor_names in email_jobs
+    ]))
+    # Rendered emails go to the outbox; a slow or failing mail API never holds up the run
+    messages = []
+    for (user_id, user_competitors, receive_email, _, _, _), mail_json in zip(email_jobs, mails):
         # Get user email from user_mails dict
         user_email = user_mails.get(user_id)
         if receive_email and user_email:
-            result = send_email(user_email, mail_json['subject'], mail_json['body'])
-            logging.info(f"Sent email to {user_email}: {result}")
+            messages.append({'_id': f"{run.run_id}:{user_id}", 'to': user_email, 'subject': mail_json['subject'],
+                             'html': mail_json['body'], 'userId': user_id, 'runId': run.run_id})
         elif not receive_email:
             logging.info(f"User {user_id} has opted out of email updates.")
         else:
             logging.warning(f"Could not find email for user {user_id}")
-    client.close()
+    outbox = get_email_outbox()
+    queued = outbox.enqueue(messages)
+    run.mark('emailed', {competitor['_id']: {} for _, user_competitors, _, _, _, _ in email_jobs
+                         for competitor in user_competitors})
+    logging.info(f"Queued {queued} emails")
+    started = _stage_done('email', started)
+    # Deliver right away; failed sends stay in the outbox and are retried by email_outbox.py
+    run_sync(outbox.deliver_due())
+    _stage_done('deliver', started)
+
+def log_run_stats(round_trips_start, metrics_start, runs=(), source='single', removed=None):
+    '''
+    Log the process's stats and its metrics since metrics_start, and store the metrics
+    summary on each run it worked on
+    '''
+    store = get_snapshot_store()
+    logging.info(f"Gemini: {run_sync(_gemini_stats())}")
+    logging.info(f"LLM cache: {get_cache_stats()}")
+    removed_note = f", {removed} unreferenced bodies removed" if removed is not None else ""
+    logging.info(f"Snapshot store: {store.stats}{removed_note}")
+    logging.info(f"Email outbox: {get_email_outbox().stats}")
+    round_trips = get_round_trips() - round_trips_start
+    logging.info(f"MongoDB: {sum(round_trips.values())} round trips ({dict(round_trips)})")
+    summary = metrics.registry.summary(metrics_start)
+    logging.info("Run metrics:\n  " + "\n  ".join(metrics.format_summary(summary)))
+    for run in runs:
+        run.record_metrics(source, summary)
+
+def main(run_id=None, resume=False):
+    '''
+    Single-process run: every due user in one batch, no job queue. With resume, continue
+    run_id (or the latest unfinished run) where it stopped instead of starting a new run.
+    '''
+    round_trips_start = get_round_trips()
+    metrics_start = metrics.registry.snapshot()
+    try:
+        db = get_db()
+        ensure_indexes(db)
+        PipelineRun.ensure_indexes(db)
+        if resume:
+            run = PipelineRun.resume(db, run_id)
+            if run is None:
+                logging.info("No unfinished run to resume")
+                return
+            logging.info(f"Resuming run {run.run_id}")
+        else:
+            run = PipelineRun.start(db, run_id)
+        run_start = datetime.utcnow()
+        user_map = load_user_competitors(db[COLLECTION_NAME])
+        scheduled_users = schedule_users(db, user_map, run.day)
+        # Emails of the scheduled users, from the user directory cache
+        user_mails = get_user_mails([user_id for user_id, _, _ in scheduled_users])
+        try:
+            run_users(db, scheduled_users, user_mails, run)
+        except Exception:
+            run.finish('failed')
+            raise
+        run.finish()
+        removed = get_snapshot_store().collect_garbage(db[COLLECTION_NAME], run_start)
+        log_run_stats(round_trips_start, metrics_start, [run], removed=removed)
+    finally:
+        shutdown_browser_pool()
+        close_client()
+
+def plan_run(run_id=None, resume=False):
+    '''
+    Queue one job per user due today for pipeline workers. With resume, failed jobs of
+    run_id (or of the latest unfinished run) are queued again instead. Unreferenced snapshot
+    bodies are collected here, and only while no worker holds a lease, since a worker may
+    have stored bodies its snapshots do not reference yet.
+    '''
+    db = get_db()
+    ensure_indexes(db)
+    PipelineRun.ensure_indexes(db)
+    queue = JobQueue(db[PIPELINE_JOBS_COLLECTION])
+    queue.ensure_indexes()
+    if queue.active_leases() == 0:
+        # The grace period covers on-demand snapshots whose competitor update is still in flight
+        older_than = datetime.utcnow() - timedelta(minutes=10)
+        removed = get_snapshot_store().collect_garbage(db[COLLECTION_NAME], older_than)
+        logging.info(f"Removed {removed} unreferenced snapshot bodies")
+    if resume:
+        run = PipelineRun.resume(db, run_id)
+        if run is None:
+            logging.info("No unfinished run to resume")
+            close_client()
+            return None
+        requeued = queue.retry_failed(run.run_id)
+        logging.info(f"Run {run.run_id}: re-queued {requeued} failed jobs")
+        close_client()
+        return run.run_id
+    run = PipelineRun.start(db, run_id, mode='distributed')
+    user_ids = [u for u in db[COLLECTION_NAME].distinct('userId') if u]
+    prefs_by_user = load_preferences(db, user_ids)
+    due = [u for u in user_ids if is_due(prefs_by_user.get(u, {}), run.day)]
+    queued = queue.enqueue(run.run_id, [{'_id': f"{run.run_id}:{u}", 'userId': u} for u in due])
+    logging.info(f"Run {run.run_id}: queued {queued} of {len(user_ids)} users")
+    close_client()
+    return run.run_id
+
+def run_worker(batch_size=PIPELINE_WORKER_BATCH):
+    '''
+    Claim user jobs from the queue and process them, batch_size users at a time, until no
+    claimable job is left. Any number of workers can run on any number of nodes. A run is
+    marked finished by the worker that sees its last job complete.
+    '''
+    round_trips_start = get_round_trips()
+    metrics_start = metrics.registry.snapshot()
+    try:
+        db = get_db()
+        queue = JobQueue(db[PIPELINE_JOBS_COLLECTION])
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        processed = failed = 0
+        runs = {}
+        while True:
+            jobs = queue.claim(worker_id, batch_size)
+            if not jobs:
+                break
+            with queue.keep_alive(jobs, worker_id) as lease:
+                # A batch can hold jobs of more than one run
+                for run_id in sorted({job['runId'] for job in jobs}):
+                    run_jobs = [job for job in jobs if job['runId'] == run_id]
+                    user_ids = [job['userId'] for job in run_jobs]
+                    # Another worker re-claims jobs whose lease expired; leave the rest of the
+                    # batch to it instead of processing the same users twice
+                    if not lease.still_held(run_jobs):
+                        logging.warning(f"Worker {worker_id} lost its leases, abandoning {len(lease.held())} users")
+                        break
+                    try:
+                        if run_id not in runs:
+                            runs[run_id] = PipelineRun.resume(db, run_id)
+                        user_map = load_user_competitors(db[COLLECTION_NAME], user_ids)
+                        prefs_by_user = load_preferences(db, user_ids)
+                        scheduled_users = [(u, user_map[u], prefs_by_user.get(u, {}).get('receiveEmail', True))
+                                           for u in user_ids if u in user_map]
+                        user_mails = get_user_mails([user_id for user_id, _, _ in scheduled_users])
+                        run_users(db, scheduled_users, user_mails, runs[run_id])
+                    except Exception as e:
+                        logging.exception(f"Worker {worker_id} failed on users {user_ids}")
+                        lease.release(run_jobs, lambda: queue.fail(run_jobs, worker_id, str(e)))
+                        failed += len(run_jobs)
+                        continue
+                    if not lease.still_held(run_jobs):
+                        logging.warning(f"Worker {worker_id} lost its leases, not completing users {user_ids}")
+                        break
+                    lease.release(run_jobs, lambda: queue.complete(run_jobs, worker_id))
+                    processed += len(run_jobs)
+        for run_id, run in runs.items():
+            status = queue.run_status(run_id)
+            if status['queued'] == status['running'] == 0:
+                run.finish('failed' if status['failed'] else 'done')
+        logging.info(f"Worker {worker_id}: {processed} users processed, {failed} failed")
+        log_run_stats(round_trips_start, metrics_start, runs.values(), source=worker_id)
+    finally:
+        shutdown_browser_pool()
+        close_client()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="CompetitorIQ change detection pipeline")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", action="store_true", help="queue one job per due user and exit")
+    mode.add_argument("--worker", action="store_true", help="process queued jobs until none is left")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue --run-id, or the latest unfinished run, instead of starting a new one")
+    parser.add_argument("--run-id", help="run id (default: current UTC time)")
+    parser.add_argument("--batch-size", type=int, default=PIPELINE_WORKER_BATCH,
+                        help="users claimed per batch with --worker")
+    args = parser.parse_args()
+    if args.plan:
+        plan_run(args.run_id, args.resume)
+    elif args.worker:
+        run_worker(args.batch_size)
+    else:
+        main(args.run_id, args.resume)
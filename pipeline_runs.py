@@ -0,0 +1,96 @@
+from datetime import datetime, date
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+PIPELINE_RUNS_COLLECTION = "pipeline_runs"
+CHECKPOINTS_COLLECTION = "pipeline_checkpoints"
+# Per-competitor stages of a run, in order
+STAGES = ('crawled', 'diffed', 'summarized', 'emailed')
+
+
+def reached(checkpoint, stage):
+    '''
+    Whether a competitor checkpoint (or None) got to stage
+    '''
+    if not checkpoint or checkpoint.get('stage') not in STAGES:
+        return False
+    return STAGES.index(checkpoint['stage']) >= STAGES.index(stage)
+
+
+class PipelineRun:
+    '''
+    Run record ({_id: run id, status: running|done|failed, day, mode, startedAt, finishedAt,
+    metrics: per-process metrics summaries}) plus one checkpoint per competitor ({_id: run id:competitor id, stage, ...stage data})
+    so a retried run only does the work that is left.
+    '''
+
+    def __init__(self, db, record):
+        self.db = db
+        self.run_id = record['_id']
+        # Users are scheduled for the day the run started, also when it is resumed later
+        self.day = date.fromisoformat(record['day'])
+        self.runs = db[PIPELINE_RUNS_COLLECTION]
+        self.checkpoints = db[CHECKPOINTS_COLLECTION]
+
+    @staticmethod
+    def ensure_indexes(db):
+        db[PIPELINE_RUNS_COLLECTION].create_index([('status', ASCENDING), ('startedAt', DESCENDING)])
+        db[CHECKPOINTS_COLLECTION].create_index([('runId', ASCENDING), ('competitorId', ASCENDING)])
+
+    @classmethod
+    def start(cls, db, run_id=None, mode='single'):
+        '''
+        Create the run record, or reopen it when run_id already exists
+        '''
+        now = datetime.utcnow()
+        run_id = run_id or now.strftime('%Y%m%dT%H%M%S')
+        runs = db[PIPELINE_RUNS_COLLECTION]
+        runs.update_one({'_id': run_id},
+                        {'$setOnInsert': {'day': date.today().isoformat(), 'mode': mode, 'startedAt': now},
+                         '$set': {'status': 'running'}},
+                        upsert=True)
+        return cls(db, runs.find_one({'_id': run_id}))
+
+    @classmethod
+    def resume(cls, db, run_id=None):
+        '''
+        Reopen run_id, or the latest run that did not finish; None when there is nothing to resume
+        '''
+        runs = db[PIPELINE_RUNS_COLLECTION]
+        if run_id:
+            record = runs.find_one({'_id': run_id})
+        else:
+            record = runs.find_one({'status': {'$ne': 'done'}}, sort=[('startedAt', DESCENDING)])
+        if record is None:
+            return None
+        runs.update_one({'_id': record['_id']}, {'$set': {'status': 'running'}})
+        return cls(db, record)
+
+    def finish(self, status='done'):
+        self.runs.update_one({'_id': self.run_id}, {'$set': {'status': status, 'finishedAt': datetime.utcnow()}})
+
+    def record_metrics(self, source, rows):
+        '''
+        Add the metrics summary of one process (the single-process run or one worker)
+        '''
+        self.runs.update_one({'_id': self.run_id},
+                             {'$push': {'metrics': {'source': source, 'at': datetime.utcnow(), 'rows': rows}}})
+
+    def load(self, competitor_ids):
+        '''
+        competitor id -> checkpoint of this run
+        '''
+        return {doc['competitorId']: doc for doc in self.checkpoints.find(
+            {'runId': self.run_id, 'competitorId': {'$in': list(competitor_ids)}})}
+
+    def mark(self, stage, entries):
+        '''
+        Move competitors to stage; entries maps competitor id -> stage data to store
+        '''
+        now = datetime.utcnow()
+        ops = [UpdateOne({'_id': f"{self.run_id}:{competitor_id}"},
+                         {'$set': dict(data, stage=stage, updatedAt=now),
+                          '$setOnInsert': {'runId': self.run_id, 'competitorId': competitor_id}},
+                         upsert=True)
+               for competitor_id, data in entries.items()]
+        if ops:
+            self.checkpoints.bulk_write(ops, ordered=False)
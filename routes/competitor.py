@@ -1,12 +1,19 @@
 from flask import Blueprint, request, jsonify
 import asyncio
+import base64
+import json
 import re
-from playwright.async_api import async_playwright
+from crawl_scheduler import CrawlScheduler
+from http_fetcher import TieredFetcher
+from browser_pool import get_browser_pool, run_sync
 from bs4 import BeautifulSoup
-from AiLib import generate_response
-from datetime import datetime
-from pymongo import MongoClient
-from threading import Thread
+from AiLib import generate_response_async
+from link_classifier import classify_links, scan_cache, LINK_FIELDS
+from html_processing_library import snapshot_page
+from snapshot_store import get_snapshot_store, diff_snapshots, SNAPSHOT_RETENTION
+from datetime import datetime, timezone
+from utils.mongo import get_db
+from background_jobs import BackgroundJobQueue, QueueFull, job_status
 from bson import ObjectId
 from urllib.parse import urljoin
 import os
@@ -15,29 +22,44 @@ load_dotenv()
 
 competitor_bp = Blueprint('competitor', __name__)
 
-# MongoDB connection helper
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = "competitorIQ"
+# MongoDB collections (the client is shared process-wide, see utils.mongo)
 COLLECTION_NAME = "competitors"
-def get_mongo_client():
-    return MongoClient(MONGO_URI)
+FETCH_STATE_COLLECTION = "fetch_state"
+SNAPSHOT_KEEP_HTML = os.getenv("SNAPSHOT_KEEP_HTML", "false").lower() == "true"
+# On-demand snapshots run on a fixed pool per web worker; further requests wait in a bounded queue
+SNAPSHOT_WORKERS = int(os.getenv("SNAPSHOT_WORKERS", "2"))
+SNAPSHOT_QUEUE_SIZE = int(os.getenv("SNAPSHOT_QUEUE_SIZE", "100"))
 
-# Helper to fetch HTML using Playwright
-async def fetch_html(url):
+snapshot_jobs = BackgroundJobQueue(SNAPSHOT_WORKERS, SNAPSHOT_QUEUE_SIZE, name='snapshot')
+
+# Helper to fetch HTML using the shared Playwright browser pool
+async def fetch_html(url, profile=None):
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-            await page.goto(url, timeout=20000)
-            html = await page.content()
-            await browser.close()
-            return html
+        return await get_browser_pool().fetch_html(url, profile=profile)
     except Exception:
         return ""
 
+FIELD_DESCRIPTIONS = {
+    'pricing': 'URL of the pricing page (if any)',
+    'blog': 'URL of the blog (if any)',
+    'releaseNotes': 'URL of release notes/changelog (if any)',
+    'playstore': 'URL of Play Store app (if any)',
+    'appstore': 'URL of App Store app (if any)',
+    'linkedin': 'URL of LinkedIn page (if any)',
+    'twitter': 'URL of Twitter/X page (if any)',
+}
+
 # Async helper for crawling and field extraction (homepage only)
 async def crawl_and_extract_fields(homepage):
-    homepage_html = await fetch_html(homepage)
+    # Repeat scans of a site are answered from the cache without crawling
+    cached = await asyncio.to_thread(scan_cache.get, homepage)
+    if cached is not None:
+        return dict(cached, custom=[])
+    fetcher = TieredFetcher(fetch_html)
+    try:
+        homepage_html = await fetcher.fetch_html(homepage)
+    finally:
+        await fetcher.close()
     # Extract all links using <a> tags and hrefs (absolute and relative)
     soup = BeautifulSoup(homepage_html, "html.parser")
     hrefs = [a.get("href") for a in soup.find_all("a", href=True)]
@@ -45,19 +67,29 @@ async def crawl_and_extract_fields(homepage):
     links = [urljoin(homepage, href) if href and not href.startswith("http") else href for href in hrefs if href]
     links = [link for link in links if link]
     links = list(set(links))
-    # 2. Use Gemini to extract required fields from links only
-    extraction_prompt = f"""
-Given the following list of links (which may be absolute or relative to the homepage), extract the following fields as a JSON object:\n- pricing: URL of the pricing page (if any)\n- blog: URL of the blog (if any)\n- releaseNotes: URL of release notes/changelog (if any)\n- playstore: URL of Play Store app (if any)\n- appstore: URL of App Store app (if any)\n- linkedin: URL of LinkedIn page (if any)\n- twitter: URL of Twitter/X page (if any)\n- custom: []\nReturn only a JSON object with these fields, and ensure all URLs are absolute (not relative).\n\nLinks:\n{links}\n"""
-    fields_json = generate_response(extraction_prompt)
-    import json
-    try:
-        match = re.search(r'\{[\s\S]*\}', fields_json)
-        if match:
-            fields = json.loads(match.group(0))
-        else:
-            fields = {}
-    except Exception:
-        fields = {}
+    # 1. Obvious links are classified locally from their host and path
+    fields, unresolved = classify_links(homepage, links)
+    complete = bool(homepage_html)
+    # 2. Use Gemini only for the fields the classifier was not sure about
+    if unresolved and links:
+        wanted = ''.join(f"- {field}: {FIELD_DESCRIPTIONS[field]}\n" for field in unresolved)
+        extraction_prompt = f"""
+Given the following list of links (which may be absolute or relative to the homepage), extract the following fields as a JSON object:\n{wanted}Return only a JSON object with these fields, and ensure all URLs are absolute (not relative).\n\nLinks:\n{links}\n"""
+        fields_json = await generate_response_async(extraction_prompt)
+        match = re.search(r'\{[\s\S]*\}', fields_json or '')
+        try:
+            extracted = json.loads(match.group(0)) if match else {}
+        except Exception:
+            extracted = {}
+        # Failed LLM answers are not cached
+        complete = complete and bool(extracted)
+        for field in unresolved:
+            if isinstance(extracted.get(field), str) and extracted[field]:
+                fields[field] = extracted[field]
+    for field in LINK_FIELDS:
+        fields.setdefault(field, None)
+    if complete:
+        await asyncio.to_thread(scan_cache.set, homepage, fields)
     fields['custom'] = []
     return fields
 
@@ -72,29 +104,39 @@ def get_tracked_urls(competitor):
     urls.extend([u for u in custom if u])
     return list(set(urls))
 
-async def crawl_urls_and_save_snapshot(competitor_id):
-    client = get_mongo_client()
-    db = client[DB_NAME]
+def crawl_urls_and_save_snapshot(competitor_id):
+    # Only the crawl runs on the shared browser loop; MongoDB I/O and parsing stay in the
+    # calling thread so they never stall renders of other requests
+    db = get_db()
     collection = db[COLLECTION_NAME]
-    competitor = collection.find_one({'_id': ObjectId(competitor_id)})
+    competitor = collection.find_one({'_id': ObjectId(competitor_id)},
+                                     {'homepage': 1, 'fields': 1, 'snapshots': {'$slice': -1}})
     if not competitor:
-        client.close()
         return
     urls = get_tracked_urls(competitor)
-    pages = []
-    for url in urls:
-        html = await fetch_html(url)
-        pages.append({'url': url, 'content': html})
+    previous = (competitor.get('snapshots') or [{}])[-1].get('pages') or []
+    fetcher = TieredFetcher(fetch_html, db[FETCH_STATE_COLLECTION])
+    fetcher.load_state(urls, previous)
+    try:
+        results = run_sync(CrawlScheduler(fetcher.fetch_html).crawl(urls))
+    finally:
+        run_sync(fetcher.close())
+    # Pages not modified since the previous snapshot come back as references to its bodies
+    pages = get_snapshot_store().put_pages(
+        [dict(results[url], url=url) if isinstance(results.get(url), dict)
+         else snapshot_page(url, results.get(url, ''), keep_html=SNAPSHOT_KEEP_HTML) for url in urls],
+        previous=previous)
+    fetcher.remember_pages(pages)
+    fetcher.save_state()
     snapshot = {
-        'date': datetime.utcnow().isoformat() + 'Z',
+        'date': datetime.utcnow(),
         'pages': pages
     }
-    # Only keep the 2 most recent snapshots
+    # Keep the SNAPSHOT_RETENTION most recent snapshots
     collection.update_one(
         {'_id': ObjectId(competitor_id)},
-        {'$push': {'snapshots': {'$each': [snapshot], '$slice': -2}}}
+        {'$push': {'snapshots': {'$each': [snapshot], '$slice': -SNAPSHOT_RETENTION}}}
     )
-    client.close()
 
 @competitor_bp.route('/api/competitors/scan', methods=['POST'])
 def scan_competitor():
@@ -103,7 +145,7 @@ def scan_competitor():
     if not homepage:
         return jsonify({'error': 'Homepage URL is required'}), 400
     try:
-        fields = asyncio.run(crawl_and_extract_fields(homepage))
+        fields = run_sync(crawl_and_extract_fields(homepage))
     except Exception as e:
         return jsonify({'error': f'Error during crawling/extraction: {str(e)}'}), 500
     return jsonify(fields), 200 
@@ -125,31 +167,123 @@ def save_competitor():
         'snapshots': []  # Start with no snapshots
     }
     try:
-        client = get_mongo_client()
-        db = client[DB_NAME]
+        db = get_db()
         collection = db[COLLECTION_NAME]
         # Check for duplicate
         existing = collection.find_one({
             'userId': user_id,
             'name': name,
             'homepage': homepage
-        })
+        }, {'_id': 1})
         if existing:
-            client.close()
             return jsonify({'error': 'Competitor already exists for this user.'}), 409
         result = collection.insert_one(doc)
-        client.close()
         return jsonify({'success': True, 'id': str(result.inserted_id)}), 201
     except Exception as e:
         return jsonify({'error': f'Error saving competitor: {str(e)}'}), 500 
 
 @competitor_bp.route('/api/competitors/<competitor_id>/snapshot', methods=['POST'])
 def trigger_snapshot(competitor_id):
-    # Start the snapshot crawl in a background thread
-    def run_bg():
-        asyncio.run(crawl_urls_and_save_snapshot(competitor_id))
-    Thread(target=run_bg, daemon=True).start()
-    return '', 202 
+    if not ObjectId.is_valid(competitor_id):
+        return jsonify({'error': 'Invalid competitor id'}), 400
+    # Queue the snapshot crawl; a crawl already queued or running for this competitor is reused
+    try:
+        job, created = snapshot_jobs.submit(competitor_id, crawl_urls_and_save_snapshot, competitor_id)
+    except QueueFull:
+        return jsonify({'error': 'Too many snapshots in progress, try again later'}), 503
+    return jsonify({'jobId': job['id'], 'status': job['status'], 'deduplicated': not created}), 202
+
+@competitor_bp.route('/api/competitors/snapshot-jobs/<job_id>', methods=['GET'])
+def get_snapshot_job(job_id):
+    job = snapshot_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(dict(job_status(job), competitorId=job['key'])), 200
+
+def _parse_utc(value):
+    '''
+    ISO date string as a naive UTC datetime, the form snapshot dates are stored in
+    '''
+    date = datetime.fromisoformat(value.rstrip('Z'))
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+def _snapshot_date(snapshot):
+    # Older on-demand snapshots stored the date as an ISO string with a trailing Z
+    date = snapshot.get('date')
+    if isinstance(date, str):
+        return _parse_utc(date)
+    return date
+
+def _snapshot_at(snapshots, when):
+    '''
+    Latest snapshot taken at or before when (snapshots are stored oldest first); legacy
+    snapshots without a date are skipped
+    '''
+    found = None
+    for snapshot in snapshots:
+        date = _snapshot_date(snapshot)
+        if date is not None and date <= when:
+            found = snapshot
+    return found
+
+@competitor_bp.route('/api/competitors/<competitor_id>/snapshots', methods=['GET'])
+def list_snapshots(competitor_id):
+    try:
+        db = get_db()
+        collection = db[COLLECTION_NAME]
+        competitor = collection.find_one({'_id': ObjectId(competitor_id)}, {'snapshots.date': 1})
+        if not competitor:
+            return jsonify({'error': 'Competitor not found'}), 404
+        dates = [_snapshot_date(s) for s in competitor.get('snapshots', [])]
+        dates = [date.isoformat() + 'Z' for date in dates if date is not None]
+        return jsonify({'snapshots': dates}), 200
+    except Exception as e:
+        return jsonify({'error': f'Error fetching snapshots: {str(e)}'}), 500
+
+@competitor_bp.route('/api/competitors/<competitor_id>/diff', methods=['GET'])
+def diff_competitor_snapshots(competitor_id):
+    '''
+    Diff the snapshots in effect at two dates (?from=...&to=..., ISO dates, UTC unless they
+    carry an offset; to defaults to now)
+    '''
+    try:
+        start = _parse_utc(request.args['from'])
+        end = request.args.get('to')
+        end = _parse_utc(end) if end else datetime.utcnow()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'from (and optional to) must be ISO dates'}), 400
+    try:
+        db = get_db()
+        collection = db[COLLECTION_NAME]
+        competitor = collection.find_one({'_id': ObjectId(competitor_id)}, {'snapshots': 1})
+        if not competitor:
+            return jsonify({'error': 'Competitor not found'}), 404
+        snapshots = competitor.get('snapshots', [])
+        snap1, snap2 = _snapshot_at(snapshots, start), _snapshot_at(snapshots, end)
+        if snap1 is None or snap2 is None:
+            return jsonify({'error': 'No snapshot at or before the requested dates'}), 404
+        return jsonify({
+            'from': _snapshot_date(snap1).isoformat() + 'Z',
+            'to': _snapshot_date(snap2).isoformat() + 'Z',
+            'diffs': diff_snapshots(snap1, snap2),
+        }), 200
+    except Exception as e:
+        return jsonify({'error': f'Error diffing snapshots: {str(e)}'}), 500
+
+def _encode_cursor(item):
+    date = item['date']
+    is_date = isinstance(date, datetime)
+    raw = json.dumps({'d': date.isoformat() if is_date else date, 't': 'date' if is_date else 'str',
+                      'id': str(item['competitorId']), 'p': item['position']})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    raw = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    date = datetime.fromisoformat(raw['d']) if raw['t'] == 'date' else raw['d']
+    # Cursors issued before positions were added resume after the whole competitor and date
+    return date, ObjectId(raw['id']), int(raw.get('p', -1))
 
 @competitor_bp.route('/api/competitors/summaries', methods=['GET'])
 def get_competitor_summaries():
@@ -157,24 +291,48 @@ def get_competitor_summaries():
     if not user_id:
         return jsonify({'error': 'Missing userId parameter'}), 400
     try:
-        client = get_mongo_client()
-        db = client[DB_NAME]
+        # Parsed here rather than with type=int, which turns a malformed limit into no limit
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        cursor = request.args.get('cursor')
+        after = _decode_cursor(cursor) if cursor else None
+    except Exception:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+    try:
+        db = get_db()
         collection = db[COLLECTION_NAME]
-        competitors = list(collection.find({'userId': user_id}))
-        all_summaries = []
-        for competitor in competitors:
-            name = competitor.get('name')
-            summaries = competitor.get('summaries', [])
-            for summary in summaries:
-                all_summaries.append({
-                    'company': name,
-                    'date': summary.get('date'),
-                    'summary': summary.get('summary')
-                })
-        # Sort all summaries by date descending
-        all_summaries.sort(key=lambda x: x['date'] if x['date'] else '', reverse=True)
-        client.close()
-        return jsonify({'summaries': all_summaries}), 200
+        # Flatten, sort and page in MongoDB; only names and summaries leave the server
+        stages = [
+            {'$match': {'userId': user_id}},
+            {'$project': {'name': 1, 'summaries': 1}},
+            # The position in the competitor's summaries keeps the sort key unique when one
+            # competitor has several summaries with the same date
+            {'$unwind': {'path': '$summaries', 'includeArrayIndex': 'position'}},
+            {'$project': {'_id': 0, 'competitorId': '$_id', 'company': '$name', 'position': 1,
+                          'date': '$summaries.date', 'summary': '$summaries.summary'}},
+        ]
+        if after:
+            date, competitor_id, position = after
+            stages.append({'$match': {'$or': [{'date': {'$lt': date}},
+                                              {'date': date, 'competitorId': {'$lt': competitor_id}},
+                                              {'date': date, 'competitorId': competitor_id,
+                                               'position': {'$lt': position}}]}})
+        stages.append({'$sort': {'date': -1, 'competitorId': -1, 'position': -1}})
+        if limit:
+            # One extra row tells whether there is a next page
+            stages.append({'$limit': limit + 1})
+        rows = list(collection.aggregate(stages))
+        response = {}
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            response['nextCursor'] = _encode_cursor(rows[-1])
+        response['summaries'] = [
+            {'company': row.get('company'), 'date': row.get('date'), 'summary': row.get('summary')}
+            for row in rows
+        ]
+        return jsonify(response), 200
     except Exception as e:
         return jsonify({'error': f'Error fetching summaries: {str(e)}'}), 500 
 
@@ -184,10 +342,9 @@ def list_competitors():
     if not user_id:
         return jsonify({'error': 'Missing userId parameter'}), 400
     try:
-        client = get_mongo_client()
-        db = client[DB_NAME]
+        db = get_db()
         collection = db[COLLECTION_NAME]
-        competitors = list(collection.find({'userId': user_id}))
+        competitors = list(collection.find({'userId': user_id}, {'name': 1, 'homepage': 1, 'fields': 1}))
         # Only return relevant fields
         result = []
         for c in competitors:
@@ -197,7 +354,6 @@ def list_competitors():
                 'homepage': c.get('homepage'),
                 'fields': c.get('fields', {}),
             })
-        client.close()
         return jsonify({'competitors': result}), 200
     except Exception as e:
         return jsonify({'error': f'Error fetching competitors: {str(e)}'}), 500 
@@ -210,14 +366,12 @@ def update_competitor(competitor_id):
     if not name or fields is None:
         return jsonify({'error': 'Missing name or fields'}), 400
     try:
-        client = get_mongo_client()
-        db = client[DB_NAME]
+        db = get_db()
         collection = db[COLLECTION_NAME]
         result = collection.update_one(
             {'_id': ObjectId(competitor_id)},
             {'$set': {'name': name, 'fields': fields}}
         )
-        client.close()
         if result.matched_count == 0:
             return jsonify({'error': 'Competitor not found'}), 404
         return jsonify({'success': True}), 200
@@ -227,11 +381,9 @@ def update_competitor(competitor_id):
 @competitor_bp.route('/api/competitors/<competitor_id>', methods=['DELETE'])
 def delete_competitor(competitor_id):
     try:
-        client = get_mongo_client()
-        db = client[DB_NAME]
+        db = get_db()
         collection = db[COLLECTION_NAME]
         result = collection.delete_one({'_id': ObjectId(competitor_id)})
-        client.close()
         if result.deleted_count == 0:
             return jsonify({'error': 'Competitor not found'}), 404
         return jsonify({'success': True}), 200
@@ -0,0 +1,284 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from bson import Binary
+from cachetools import LRUCache
+from pymongo import UpdateOne
+from html_processing_library import page_paragraphs as inline_page_paragraphs, page_fingerprint, DIFF_SECONDS
+from paragraph_diff import diff_paragraph_lists, copy_runs
+from utils.mongo import get_db
+import dotenv
+
+dotenv.load_dotenv()
+
+SNAPSHOT_BODIES_COLLECTION = "snapshot_bodies"
+# "zstd" needs the optional zstandard package; gzip is always available
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "gzip")
+SNAPSHOT_BODY_CACHE_SIZE = int(os.getenv("SNAPSHOT_BODY_CACHE_SIZE", "2048"))
+# Snapshots kept per competitor; with daily runs the default is about three months
+SNAPSHOT_RETENTION = int(os.getenv("SNAPSHOT_RETENTION", "90"))
+# A body is stored in full instead of as a delta once its base chain reaches this length
+SNAPSHOT_MAX_DELTA_CHAIN = int(os.getenv("SNAPSHOT_MAX_DELTA_CHAIN", "10"))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    # mtime=0 keeps the output deterministic for identical bodies
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def _decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Snapshot body is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def apply_delta(base, delta):
+    '''
+    Inverse of paragraph_diff.copy_runs: rebuild a paragraph list from its base and delta
+    '''
+    paragraphs = []
+    for op in delta:
+        if isinstance(op, list):
+            start, count = op
+            paragraphs.extend(base[start:start + count])
+        else:
+            paragraphs.append(op)
+    return paragraphs
+
+
+class SnapshotStore:
+    '''
+    Content-addressed storage for snapshot page bodies (paragraph lists, plus raw HTML when
+    kept). Bodies are compressed and stored once per content hash, so identical pages across
+    competitors and runs share one document; snapshots only keep small page references.
+    Bodies are immutable, so loaded ones are cached in an LRU.
+
+    A page body whose previous version (same URL, previous snapshot) is known is stored as a
+    delta over that version's paragraphs when that is smaller; chains are cut at
+    SNAPSHOT_MAX_DELTA_CHAIN so loading an old body never resolves too many bases.
+    '''
+
+    def __init__(self, collection=None, codec=SNAPSHOT_CODEC, cache_size=SNAPSHOT_BODY_CACHE_SIZE):
+        if codec == "zstd" and zstandard is None:
+            logging.warning("SNAPSHOT_CODEC=zstd but zstandard is not installed, using gzip")
+            codec = "gzip"
+        self._collection = collection
+        self.codec = codec
+        self._cache = LRUCache(maxsize=cache_size)
+        # Delta chain length per cached body, 0 for bodies stored in full
+        self._depth = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+        self.stats = {'bodies_written': 0, 'bodies_reused': 0, 'bodies_loaded': 0, 'deltas_written': 0,
+                      'bytes_raw': 0, 'bytes_stored': 0}
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_db()[SNAPSHOT_BODIES_COLLECTION]
+        return self._collection
+
+    @staticmethod
+    def _serialize(body):
+        return json.dumps(body, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+    def _encode(self, raw, body, base_key):
+        '''
+        Document fields for a new body: a delta over base_key when that is smaller, else in full
+        '''
+        data = _compress(raw, self.codec)
+        fields = {'codec': self.codec, 'data': Binary(data), 'rawSize': len(raw)}
+        depth = 0
+        if base_key is not None and 'content' not in body:
+            base = self._load(base_key)
+            base_depth = self._depth.get(base_key)
+            if base is not None and base_depth is not None and base_depth < SNAPSHOT_MAX_DELTA_CHAIN:
+                delta = _compress(self._serialize(copy_runs(base['paragraphs'], body['paragraphs'])), self.codec)
+                if len(delta) < len(data):
+                    data = delta
+                    depth = base_depth + 1
+                    fields.update({'data': Binary(data), 'base': base_key, 'depth': depth})
+        return fields, depth
+
+    def put_pages(self, pages, previous=None):
+        '''
+        Store the bodies of inline snapshot pages and return the page references to save
+        in the snapshot: {'url', 'fingerprint', 'body'}. Pages that already are references
+        are returned unchanged. previous holds the pages of the competitor's last snapshot;
+        new bodies are delta-encoded against the body of the same URL there.
+        '''
+        previous_bodies = {p['url']: p['body'] for p in previous or [] if 'body' in p}
+        now = datetime.utcnow()
+        refs, ops, depths = [], {}, {}
+        for page in pages:
+            if 'body' in page:
+                refs.append(page)
+                continue
+            body = {'paragraphs': inline_page_paragraphs(page)}
+            if 'content' in page:
+                body['content'] = page['content']
+            raw = self._serialize(body)
+            key = hashlib.sha256(raw).hexdigest()
+            if key not in ops:
+                with self._lock:
+                    known = key in self._cache
+                if known:
+                    # Stored before, but garbage collection in another process may have removed
+                    # it since: upsert it in full, which keeps an existing document as it is
+                    fields, depth = self._encode(raw, body, None)
+                else:
+                    base_key = previous_bodies.get(page['url'])
+                    fields, depth = self._encode(raw, body, base_key if base_key != key else None)
+                    self.stats['bytes_raw'] += len(raw)
+                    self.stats['bytes_stored'] += len(fields['data'])
+                    self.stats['deltas_written'] += 'base' in fields
+                    with self._lock:
+                        self._cache[key] = body
+                depths[key] = depth
+                fields['createdAt'] = now
+                # lastUsedAt keeps the body from garbage collection until the snapshot
+                # referencing it is saved
+                ops[key] = UpdateOne({'_id': key}, {'$setOnInsert': fields, '$set': {'lastUsedAt': now}},
+                                     upsert=True)
+            refs.append({'url': page['url'], 'fingerprint': page.get('fingerprint'), 'body': key})
+        if ops:
+            result = self.collection.bulk_write(list(ops.values()), ordered=False)
+            self.stats['bodies_written'] += result.upserted_count
+            self.stats['bodies_reused'] += len(ops) - result.upserted_count
+            self._record_depths(depths, set(result.upserted_ids.values()))
+        return refs
+
+    def _record_depths(self, depths, inserted):
+        '''
+        Cache the delta chain length of the bodies just written. A body that already existed
+        keeps its stored encoding, whose depth may differ from the one computed here, so
+        it is read back
+        '''
+        existing = [key for key in depths if key not in inserted]
+        stored = {doc['_id']: doc.get('depth', 0) for doc in self.collection.find(
+            {'_id': {'$in': existing}}, {'depth': 1})} if existing else {}
+        with self._lock:
+            for key, depth in depths.items():
+                if key in inserted:
+                    self._depth[key] = depth
+                elif key in stored:
+                    self._depth[key] = stored[key]
+                else:
+                    self._depth.pop(key, None)
+
+    def _load(self, key):
+        with self._lock:
+            body = self._cache.get(key)
+        if body is not None:
+            return body
+        doc = self.collection.find_one({'_id': key})
+        if doc is None:
+            return None
+        data = json.loads(_decompress(doc['data'], doc.get('codec', 'gzip')))
+        if 'base' in doc:
+            base = self._load(doc['base'])
+            if base is None:
+                logging.warning(f"Base {doc['base']} of snapshot body {key} is missing")
+                return None
+            data = {'paragraphs': apply_delta(base['paragraphs'], data)}
+        self.stats['bodies_loaded'] += 1
+        with self._lock:
+            self._cache[key] = data
+            self._depth[key] = doc.get('depth', 0)
+        return data
+
+    def load(self, key):
+        body = self._load(key)
+        if body is None:
+            logging.warning(f"Snapshot body {key} is missing")
+            return {'paragraphs': []}
+        return body
+
+    def page_paragraphs(self, page):
+        '''
+        Paragraph list of a snapshot page, loading its body from the store only when needed
+        '''
+        if 'body' in page:
+            return self.load(page['body'])['paragraphs']
+        return inline_page_paragraphs(page)
+
+    def collect_garbage(self, competitors, older_than):
+        '''
+        Delete bodies no competitor snapshot references any more. Only bodies last stored
+        before older_than are considered, so pages written by a concurrent crawl are never removed.
+        '''
+        referenced = {doc['_id'] for doc in competitors.aggregate([
+            {'$unwind': '$snapshots'},
+            {'$unwind': '$snapshots.pages'},
+            {'$match': {'snapshots.pages.body': {'$exists': True}}},
+            {'$group': {'_id': '$snapshots.pages.body'}},
+        ], allowDiskUse=True)}
+        unused = {'$or': [{'lastUsedAt': {'$lt': older_than}},
+                          {'lastUsedAt': {'$exists': False}, 'createdAt': {'$lt': older_than}}]}
+        candidates = {doc['_id'] for doc in self.collection.find(unused, {'_id': 1})} - referenced
+        # Delta bodies need their whole base chain, also those of recently stored bodies
+        frontier = list(referenced | {doc['_id'] for doc in self.collection.find(
+            {'$nor': [unused]}, {'_id': 1})})
+        kept = set(frontier)
+        while frontier:
+            bases = {doc['base'] for doc in self.collection.find(
+                {'_id': {'$in': frontier}, 'base': {'$exists': True}}, {'base': 1})}
+            frontier = list(bases - kept)
+            kept |= bases
+        stale = list(candidates - kept)
+        if stale:
+            self.collection.delete_many({'_id': {'$in': stale}})
+        return len(stale)
+
+
+def diff_snapshots(snap1, snap2, store=None):
+    '''
+    Diff two snapshots per URL on their stored paragraph lists, skipping pages whose
+    fingerprints match or whose paragraphs were only reordered. Page bodies are loaded from
+    the snapshot store only for URLs that changed. Moved paragraphs are left out of the diff
+    and noted with a count. An empty result means nothing changed.
+    '''
+    store = store or get_snapshot_store()
+    diff_by_url = {}
+    pages1 = {p['url']: p for p in snap1.get('pages', [])}
+    pages2 = {p['url']: p for p in snap2.get('pages', [])}
+    all_urls = set(pages1) | set(pages2)
+    for url in all_urls:
+        page1 = pages1.get(url, {})
+        page2 = pages2.get(url, {})
+        if page_fingerprint(page1) == page_fingerprint(page2):
+            continue
+        paragraphs1, paragraphs2 = store.page_paragraphs(page1), store.page_paragraphs(page2)
+        with DIFF_SECONDS.time():
+            diff, moved = diff_paragraph_lists(paragraphs1, paragraphs2)
+        if not diff:
+            logging.info(f"Only reordered paragraphs on {url} ({len(moved)} moved)")
+            continue
+        if moved:
+            diff.append(f"~ {len(moved)} paragraphs moved without changes")
+        diff_by_url[url] = '\n'.join(diff)
+    return diff_by_url
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore()
+        return _store
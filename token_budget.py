@@ -0,0 +1,78 @@
+from AiLib import estimate_tokens
+
+
+def truncate_diff(diff, max_tokens):
+    '''
+    Shrink a unified diff to roughly max_tokens: context lines go first since they carry
+    the least signal, then the tail is cut with a marker saying how much was dropped
+    '''
+    if estimate_tokens(diff) <= max_tokens:
+        return diff
+    lines = diff.split('\n')
+    changed = [line for line in lines if line[:1] in ('+', '-', '@', '~')]
+    text = '\n'.join(changed)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    kept = text[:max(0, max_tokens * 4 - 64)]
+    kept = kept[:kept.rfind('\n')] if '\n' in kept else kept
+    omitted = len(changed) - kept.count('\n') - 1
+    return f"{kept}\n... [diff truncated, {omitted} more changed lines omitted]"
+
+
+def allocate_budget(diff_by_url, budget):
+    '''
+    Fit all diffs into budget tokens by giving every URL the same cap (water-filling):
+    small diffs stay whole and only the largest ones are truncated
+    '''
+    sizes = {url: estimate_tokens(diff) for url, diff in diff_by_url.items()}
+    if sum(sizes.values()) <= budget:
+        return dict(diff_by_url)
+    remaining = budget
+    cap = 0
+    ordered = sorted(sizes.items(), key=lambda item: item[1])
+    for k, (_, size) in enumerate(ordered):
+        share = remaining // (len(ordered) - k)
+        if size > share:
+            cap = share
+            break
+        remaining -= size
+    return {url: truncate_diff(diff, cap) if sizes[url] > cap else diff for url, diff in diff_by_url.items()}
+
+
+def _split_diff(diff, max_tokens):
+    parts, current, current_tokens = [], [], 0
+    for line in diff.split('\n'):
+        tokens = estimate_tokens(line)
+        if current and current_tokens + tokens > max_tokens:
+            parts.append('\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        parts.append('\n'.join(current))
+    return parts
+
+
+def chunk_diffs(diff_by_url, chunk_tokens):
+    '''
+    Pack per-URL diffs into chunks of at most chunk_tokens each. A diff larger than a
+    chunk is split on line boundaries into labelled parts.
+    '''
+    items = []
+    for url, diff in diff_by_url.items():
+        if estimate_tokens(diff) <= chunk_tokens:
+            items.append((url, diff))
+            continue
+        parts = _split_diff(diff, chunk_tokens)
+        items.extend((f"{url} (part {k + 1}/{len(parts)})", part) for k, part in enumerate(parts))
+    chunks, current, current_tokens = [], {}, 0
+    for url, diff in items:
+        tokens = estimate_tokens(diff)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(current)
+            current, current_tokens = {}, 0
+        current[url] = diff
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
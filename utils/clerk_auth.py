@@ -26,11 +26,12 @@ def authenticate_and_get_user_details(request):
     except Exception as e:
         raise HTTPException(status=500, detail="Invalid credentials")
 
-def get_user_mails():
-    user_details = clerk_sdk.users.list()
-
-    return {
-        user.id: user.email_addresses[0].email_address
-        for user in user_details
-        if user.email_addresses  
-    }
\ No newline at end of file
+def get_user_mails(user_ids=None):
+    '''
+    user id -> email for user_ids, through the cached user directory. Without user_ids,
+    every Clerk user is listed (uncached).
+    '''
+    from utils.user_directory import get_user_directory
+    if user_ids is None:
+        return get_user_directory().all_emails()
+    return get_user_directory().get_emails(user_ids)
@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Prefix of every metric name in the Prometheus output
+METRICS_PREFIX = "competitoriq_"
+# Latency buckets in seconds, from an in-memory lookup to a slow browser render or Gemini call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, full_name):
+        return [f"{full_name}{_label_text(self.labels, key)} {value}"
+                for key, value in sorted(self.snapshot().items())]
+
+
+class Histogram(_Metric):
+    '''
+    Cumulative-bucket histogram of observed values (seconds unless the name says otherwise)
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][slot] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def render(self, full_name):
+        lines = []
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f"{full_name}_bucket{_label_text(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{full_name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{full_name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+    def quantile(self, counts, q):
+        '''
+        Upper bound of the bucket holding quantile q of the bucket counts
+        '''
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    '''
+    Metrics of this process. Metrics are process-local: behind several web workers every
+    worker serves its own counts, so scrape each worker or sum them in the query.
+    '''
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered with another type or labels")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        '''
+        Every metric in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            # Counter samples carry the _total suffix, and HELP/TYPE must name them the same way
+            full_name = self.prefix + metric.name + ('_total' if metric.kind == 'counter' else '')
+            lines.append(f"# HELP {full_name} {metric.help}")
+            lines.append(f"# TYPE {full_name} {metric.kind}")
+            lines.extend(metric.render(full_name))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def summary(self, since=None):
+        '''
+        What changed since an earlier snapshot() as a list of rows: counters as
+        {metric, labels, value}, histograms as {metric, labels, count, seconds, p50, p95}
+        with p50/p95 the bucket upper bounds
+        '''
+        since = since or {}
+        rows = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            before = since.get(metric.name, {})
+            for key, value in sorted(metric.snapshot().items()):
+                labels = dict(zip(metric.labels, key))
+                if isinstance(metric, Counter):
+                    delta = value - before.get(key, 0)
+                    if delta:
+                        rows.append({'metric': metric.name, 'labels': labels, 'value': delta})
+                    continue
+                counts, total, count = value
+                old_counts, old_total, old_count = before.get(key, ([0] * len(counts), 0.0, 0))
+                if count == old_count:
+                    continue
+                counts = [n - m for n, m in zip(counts, old_counts)]
+                rows.append({'metric': metric.name, 'labels': labels, 'count': count - old_count,
+                             'seconds': round(total - old_total, 3),
+                             'p50': metric.quantile(counts, 0.5), 'p95': metric.quantile(counts, 0.95)})
+        return rows
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.counter(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return registry.histogram(name, help, labels, buckets)
+
+
+def timed(metric, **labels):
+    '''
+    Decorator observing the duration of every call of a function or coroutine function
+    '''
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with metric.time(**labels):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with metric.time(**labels):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def format_summary(rows):
+    '''
+    One log line per summary row
+    '''
+    lines = []
+    for row in rows:
+        labels = ','.join(f"{k}={v}" for k, v in row['labels'].items())
+        name = f"{row['metric']}[{labels}]" if labels else row['metric']
+        if 'value' in row:
+            lines.append(f"{name}: {row['value']}")
+        else:
+            lines.append(f"{name}: {row['count']} in {row['seconds']:.2f}s (p50 <= {row['p50']}s, "
+                         f"p95 <= {row['p95']}s)")
+    return lines
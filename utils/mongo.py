@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+from collections import Counter
+from pymongo import MongoClient, ASCENDING, monitoring
+from utils import metrics
+import dotenv
+
+dotenv.load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("MONGO_DB_NAME", "competitorIQ")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+MONGO_COMMAND_SECONDS = metrics.histogram('mongo_command_seconds', 'MongoDB command round trip time', ['command'])
+MONGO_COMMAND_FAILURES = metrics.counter('mongo_command_failures', 'MongoDB commands that failed', ['command'])
+
+
+class _RoundTripCounter(monitoring.CommandListener):
+    '''
+    Counts commands sent to the server by name; every command is one round trip. Also feeds
+    the command latency and failure metrics.
+    '''
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_COMMAND_FAILURES.inc(command=event.command_name)
+
+
+_round_trips = _RoundTripCounter()
+
+
+def get_round_trips():
+    '''
+    Snapshot of the commands sent so far in this process, by command name. Subtract two
+    snapshots to get the round trips of a run.
+    '''
+    with _round_trips._lock:
+        return Counter(_round_trips.counts)
+
+
+def get_client():
+    '''
+    Process-wide MongoClient, created on first use. A forked child (e.g. a gunicorn worker
+    forked after import) gets its own client, since pymongo clients are not fork-safe.
+    '''
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, event_listeners=[_round_trips])
+            _client_pid = os.getpid()
+        return _client
+
+
+def get_db():
+    return get_client()[DB_NAME]
+
+
+def close_client():
+    global _client
+    with _lock:
+        client = _client if _client_pid == os.getpid() else None
+        _client = None
+    if client is not None:
+        client.close()
+
+
+def ensure_indexes(db=None):
+    '''
+    Create the indexes the API and pipeline queries rely on; safe to call on every startup
+    '''
+    db = db if db is not None else get_db()
+    db.competitors.create_index([('userId', ASCENDING)])
+    # Duplicate check in save_competitor
+    db.competitors.create_index([('userId', ASCENDING), ('name', ASCENDING), ('homepage', ASCENDING)])
+    db.user_preferences.create_index([('userId', ASCENDING)])
+    # Due messages for the email delivery worker
+    db.email_outbox.create_index([('status', ASCENDING), ('nextAttemptAt', ASCENDING)])
+    logging.info("MongoDB indexes ensured")
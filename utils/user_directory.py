@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from pymongo import UpdateOne
+from utils.mongo import get_db
+import dotenv
+
+dotenv.load_dotenv()
+
+USER_DIRECTORY_COLLECTION = "user_directory"
+# Cached emails older than this are refreshed from Clerk when a run needs them
+USER_DIRECTORY_TTL_HOURS = float(os.getenv("USER_DIRECTORY_TTL_HOURS", "24"))
+# Users per Clerk list request (Clerk allows up to 500); also the size of user id filters
+CLERK_PAGE_SIZE = int(os.getenv("CLERK_PAGE_SIZE", "100"))
+
+
+def primary_email(user):
+    '''
+    The user's primary email address, falling back to the first one
+    '''
+    addresses = user.email_addresses or []
+    for address in addresses:
+        if address.id == getattr(user, 'primary_email_address_id', None):
+            return address.email_address
+    return addresses[0].email_address if addresses else None
+
+
+class UserDirectory:
+    '''
+    User id -> email lookup backed by Clerk, cached in MongoDB so pipeline runs and API workers
+    share it. Only the ids asked for are looked up; entries older than the TTL are refreshed
+    from Clerk in paginated, id-filtered list calls. Users Clerk does not know are cached as
+    missing too, and when Clerk is unreachable the stale entries are used.
+    '''
+
+    def __init__(self, clerk=None, collection=None, ttl=timedelta(hours=USER_DIRECTORY_TTL_HOURS),
+                 page_size=CLERK_PAGE_SIZE):
+        self._clerk = clerk
+        self._collection = collection
+        self.ttl = ttl
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self.stats = {'cached': 0, 'fetched': 0, 'clerk_calls': 0}
+
+    @property
+    def clerk(self):
+        if self._clerk is None:
+            from utils.clerk_auth import clerk_sdk
+            self._clerk = clerk_sdk
+        return self._clerk
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_db()[USER_DIRECTORY_COLLECTION]
+        return self._collection
+
+    def _list(self, **request):
+        '''
+        Every user matching request, one page at a time
+        '''
+        offset = 0
+        while True:
+            page = self.clerk.users.list(request=dict(request, limit=self.page_size, offset=offset)) or []
+            with self._lock:
+                self.stats['clerk_calls'] += 1
+            yield from page
+            if len(page) < self.page_size:
+                return
+            offset += self.page_size
+
+    def fetch(self, user_ids):
+        '''
+        Emails of user_ids straight from Clerk (None for users without one)
+        '''
+        user_ids = list(user_ids)
+        emails = {}
+        for k in range(0, len(user_ids), self.page_size):
+            for user in self._list(user_id=user_ids[k:k + self.page_size]):
+                emails[user.id] = primary_email(user)
+        return emails
+
+    def get_emails(self, user_ids):
+        '''
+        user id -> email for the given users that have one
+        '''
+        user_ids = set(user_ids)
+        now = datetime.utcnow()
+        cached = {doc['_id']: doc for doc in self.collection.find({'_id': {'$in': list(user_ids)}})}
+        stale = [u for u in user_ids if u not in cached or cached[u]['refreshedAt'] <= now - self.ttl]
+        emails = {u: doc.get('email') for u, doc in cached.items()}
+        if stale:
+            try:
+                fetched = self.fetch(stale)
+            except Exception as e:
+                logging.warning(f"Clerk user lookup failed, using cached emails: {e}")
+                fetched = None
+            if fetched is not None:
+                self.collection.bulk_write([
+                    UpdateOne({'_id': u}, {'$set': {'email': fetched.get(u), 'refreshedAt': now}}, upsert=True)
+                    for u in stale
+                ], ordered=False)
+                emails.update({u: fetched.get(u) for u in stale})
+        with self._lock:
+            self.stats['cached'] += len(user_ids) - len(stale)
+            self.stats['fetched'] += len(stale)
+        return {u: email for u, email in emails.items() if email}
+
+    def all_emails(self):
+        '''
+        Every Clerk user with an email, bypassing the cache
+        '''
+        return {user.id: email for user in self._list() if (email := primary_email(user))}
+
+
+class FakeClerk:
+    '''
+    Local stand-in for the Clerk SDK's users.list for tests and benchmarks: serves users from
+    a dict of user id -> email with the same filtering and pagination, and counts calls.
+    '''
+
+    def __init__(self, emails):
+        self.users = self
+        self.calls = 0
+        self._users = [SimpleNamespace(id=user_id, primary_email_address_id=f"email_{user_id}",
+                                       email_addresses=[SimpleNamespace(id=f"email_{user_id}", email_address=email)])
+                       for user_id, email in emails.items()]
+
+    def list(self, request=None):
+        request = request or {}
+        self.calls += 1
+        users = self._users
+        if request.get('user_id') is not None:
+            wanted = set(request['user_id'])
+            users = [user for user in users if user.id in wanted]
+        offset, limit = request.get('offset', 0), request.get('limit', 10)
+        return users[offset:offset + limit]
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_user_directory():
+    global _directory
+    with _directory_lock:
+        if _directory is None:
+            _directory = UserDirectory()
+        return _directory